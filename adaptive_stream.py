@@ -0,0 +1,93 @@
+import time
+from config import Config as cfg
+
+
+class AdaptiveStreamController:
+    '''
+    Recommends image stream settings for the worker based on how well the
+    CameraStreamServer keeps up. The stream is degraded one level at a time
+    when frames queue up, get dropped, take too long to decode or arrive
+    with high jitter, and restored one level at a time after it has been
+    healthy for a while. Each level lowers the JPEG quality first, then the
+    resolution and finally the frame rate. With keep_resolution the image
+    size is never changed, e.g. while the frames are fed to SLAM: the
+    virtual camera is sized by the first frame and the SLAM intrinsics
+    are calibrated for the full resolution.
+
+    update() returns a config dict with 'image_quality', 'image_size' and
+    'image_stream_frequency' whenever the recommendation changes, which can
+    be sent to the worker with ControllStreamServer.send_config().
+    '''
+    def __init__(self, image_server,
+                 quality=cfg.get('image_quality'),
+                 image_size=cfg.get('image_size'),
+                 frequency=cfg.get('image_stream_frequency'),
+                 min_quality=40,
+                 keep_resolution=False,
+                 recovery_time=5.0,
+                 cooldown=1.0):
+        self.image_server = image_server
+        self.recovery_time = recovery_time  # seconds of healthy stream before stepping up
+        self.cooldown = cooldown            # minimum seconds between two changes
+        self.levels = self._build_levels(quality, image_size, frequency, min_quality, keep_resolution)
+        self.level = 0
+        self._last_change = 0.0
+        self._healthy_since = time.monotonic()
+        self._last_dropped = image_server.dropped_frames
+
+    @staticmethod
+    def _build_levels(quality, image_size, frequency, min_quality, keep_resolution):
+        width, height = image_size
+        levels = []
+        # Lower the quality first, it is the cheapest change for SLAM. A
+        # quality below min_quality is kept as the only quality level
+        for q in range(int(quality), min(min_quality, int(quality)) - 1, -10):
+            levels.append((q, [width, height], frequency))
+        q = levels[-1][0]
+        # Then the resolution
+        if not keep_resolution:
+            for scale in (0.75, 0.5):
+                levels.append((q, [int(width * scale), int(height * scale)], frequency))
+        size = levels[-1][1]
+        # And finally the frame rate
+        for factor in (0.75, 0.5):
+            levels.append((q, size, max(1, int(frequency * factor))))
+        return levels
+
+    def recommendation(self):
+        quality, image_size, frequency = self.levels[self.level]
+        return {
+            'image_quality': quality,
+            'image_size': image_size,
+            'image_stream_frequency': frequency,
+        }
+
+    def is_congested(self):
+        health = self.image_server.health
+        dropped = self.image_server.dropped_frames
+        new_drops = dropped - self._last_dropped
+        self._last_dropped = dropped
+
+        frequency = self.levels[self.level][2]
+        period = 1 / frequency
+        return (new_drops > 0
+                or self.image_server.queue_depth() > 1
+                or health.mean_decode_time() > 0.8 * period
+                or health.jitter() > 0.5 * period)
+
+    def update(self):
+        now = time.monotonic()
+        if self.is_congested():
+            self._healthy_since = now
+            if self.level < len(self.levels) - 1 and now - self._last_change > self.cooldown:
+                return self._change_level(self.level + 1, now)
+        elif self.level > 0 and now - self._healthy_since > self.recovery_time:
+            self._healthy_since = now
+            return self._change_level(self.level - 1, now)
+        return None
+
+    def _change_level(self, level, now):
+        self.level = level
+        self._last_change = now
+        print(f"Image Stream: adapting stream to {self.recommendation()}")
+        return self.recommendation()
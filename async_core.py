@@ -0,0 +1,83 @@
+import asyncio
+import logging
+import threading
+import zmq.asyncio
+
+from config import Config as cfg
+from camera_stream_server import CameraStreamServer, RouterCameraStreamServer
+from controll_stream_server import ControllStreamServer, RouterControllStreamServer
+
+
+class AsyncControllerCore:
+    '''
+    Runs the image stream server, the controll stream server and the Stella
+    VSLAM status polling as coroutines on one asyncio event loop in a single
+    background thread, instead of one blocking thread per socket.
+    stop() cancels all coroutines, closes the sockets and terminates the
+    ZMQ context.
+    '''
+    def __init__(self, stella_connector=None, stella_poll_interval=2.0):
+        self.context = zmq.asyncio.Context()
+        if cfg.get('multi_worker'):
+            self.image_server = RouterCameraStreamServer(port=cfg.get('image_stream_port'), context=self.context)
+            self.controll_server = RouterControllStreamServer(port=cfg.get('controll_port'), context=self.context)
+        else:
+            self.image_server = CameraStreamServer(port=cfg.get('image_stream_port'), context=self.context)
+            self.controll_server = ControllStreamServer(port=cfg.get('controll_port'), context=self.context)
+        self.stella_connector = stella_connector
+        self.stella_poll_interval = stella_poll_interval
+        self.stella_running = False # result of the last Stella container check
+
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, daemon=True)
+        self._main_future = None
+        self._closed = threading.Event()
+
+    def start(self):
+        # The servers only start their helper threads, the sockets are
+        # served by the coroutines in _main
+        self.image_server.start(receive_thread=False)
+        self.controll_server.start(communication_thread=False)
+        self._thread.start()
+        self._main_future = asyncio.run_coroutine_threadsafe(self._main(), self._loop)
+        self._main_future.add_done_callback(self._on_main_done)
+
+    def stop(self, timeout=2.0):
+        if self._main_future is not None:
+            self._main_future.cancel()
+            self._closed.wait(timeout)
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join(timeout)
+        self._loop.close()
+        self.context.term()
+
+    def _on_main_done(self, future):
+        # Nothing else waits for the future, so an error would go unnoticed
+        if not future.cancelled() and future.exception() is not None:
+            logging.error('Async core: networking stopped', exc_info=future.exception())
+
+    async def _main(self):
+        tasks = [
+            asyncio.create_task(self.image_server.receive_loop_async()),
+            asyncio.create_task(self.controll_server.communication_loop_async()),
+        ]
+        if self.stella_connector is not None:
+            tasks.append(asyncio.create_task(self._poll_stella()))
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            # The sockets belong to this thread, so they are closed here
+            self.image_server.close()
+            self.controll_server.close()
+            self._closed.set()
+
+    async def _poll_stella(self):
+        while True:
+            try:
+                self.stella_running = await self.stella_connector.check_stella_containers_async()
+            except Exception:
+                self.stella_running = False
+            await asyncio.sleep(self.stella_poll_interval)
@@ -4,6 +4,8 @@ import pygame as pg
 from pygame.math import Vector2
 
 from config import Config as cfg
+from trace_buffer import TraceBuffer, TraceLOD
+from render_geometry import CarGeometry
 
 class CarModel:
     def __init__(self, x, y):
@@ -13,6 +15,9 @@ class CarModel:
         self.acceleration_speed = 0 # meters per second
         self.steering_speed =   0   # degrees per second
         self.max_steering = 0       # degrees
+        self.physics_rate = 0       # physics steps per second
+        self.magic_number = 0       # temporary fix for bug with velocity calculation, see model_calibration.py
+        self.geometry = None        # template polygons for drawing, rebuilt when the dimensions change
         self.load_parameters()
 
         self.position = Vector2(x, y)                # position in meters
@@ -24,25 +29,61 @@ class CarModel:
         self.steering_rotation_point = Vector2(0, 0) # point around which the car is rotating
         self.rotation_position = -1                  # 1.0 = front, -1.0 = back
 
-        self.magic_number = 0.014 # temporary fix for bug with velocity calculation
+        # Fixed timestep integration, see advance()
+        self.time_scale = 10      # model time units per second, the constants are tuned for dt = milliseconds / 100
+        self.max_substeps = 8     # physics steps per frame before the simulation falls behind
+        self.max_frame_time = 0.25 # seconds, longer frame hitches are clamped
+        self._accumulator = 0.0   # real time not yet simulated in seconds
+        self._previous_position = Vector2(x, y)
+        self._previous_heading = Vector2(self.heading)
+        self.render_position = Vector2(x, y)        # pose interpolated between the last two physics steps
+        self.render_heading = Vector2(self.heading)
 
         self.camera_position = Vector2(0, 0) # position of the camera in the world
         self.camera_position_smooth = Vector2(0, 0) # smoothed position of the camera in the world
 
         self.ppu = 64           # pixels per unit
+        self._grid_tile = None  # pre-rendered grid, see _draw_grid
+        self._grid_tile_key = None
         self.draw_track_projection = False # draw the track the car is moving on
 
-        self.trace = [] # list of points that the car has passed
+        self.trace = TraceBuffer() # points that the car has passed
+        self.trace_lod = TraceLOD(self.trace) # simplified trace for drawing
         self.draw_trace = True # draw the track the car has passed
 
-        self.trace_tires = [[],[]] # list of points that the tires have passed
+        self.trace_tires = [TraceBuffer(500), TraceBuffer(500)] # points that the tires have passed
         self.draw_tire_trace = False # draw the track the tires have passed
 
 
+    def advance(self, frame_time):
+        '''
+        Advance the simulation by frame_time seconds of real time in fixed
+        steps of 1 / physics_rate seconds, independent of the frame rate.
+        Time that does not fill a whole step is carried over to the next
+        frame and used to interpolate the pose that is drawn.
+        '''
+        step = 1 / max(self.physics_rate, 1)
+        self._accumulator += min(frame_time, self.max_frame_time)
+        substeps = 0
+        while self._accumulator >= step and substeps < self.max_substeps:
+            self._previous_position = Vector2(self.position)
+            self._previous_heading = Vector2(self.heading)
+            self.update(step * self.time_scale)
+            self._accumulator -= step
+            substeps += 1
+        # One trace point per frame like before the fixed timestep, not per physics step
+        if substeps:
+            self._update_trace()
+        # Drop the time we can not catch up on instead of falling further behind
+        self._accumulator %= step
+
+        alpha = self._accumulator / step
+        self.render_position = self._previous_position.lerp(self.position, alpha)
+        self.render_heading = self._previous_heading.slerp(self.heading, alpha)
+
     def update(self, dt):
+        '''Integrate a single step of dt model time units'''
         self._update_position(dt)
-        self._update_trace()
-        self._update_trace()
         self._update_inputs(dt)
         self._calculate_steering_rotation_point()
 
@@ -54,6 +95,10 @@ class CarModel:
         self.max_velocity = cfg.get("max_velocity")
         self.acceleration_speed = cfg.get("acceleration")
         self.steering_speed = cfg.get("steering_speed")
+        self.physics_rate = cfg.get("physics_rate")
+        self.magic_number = cfg.get("magic_number")
+        if self.geometry is None or not self.geometry.matches(self.length, self.width):
+            self.geometry = CarGeometry(self.length, self.width)
 
     def _update_position(self, dt):
         # If steering is 0, move in a straight line
@@ -123,7 +168,7 @@ class CarModel:
             self.temp_trace_counter = 1
         self.temp_trace_counter += 1
 
-        self.trace.append(self.position)
+        self.trace.append((self.position.x, self.position.y))
 
         # Only update the trace from tires when moving fast enough
         # and every x frames
@@ -140,11 +185,7 @@ class CarModel:
         for i in range(len(tires)):
             tires[i] = tires[i].rotate(angle)
             tires[i] += self.position
-            self.trace_tires[i].append(tires[i])
-            
-            if len(self.trace_tires[i]) > 500:
-                for j in range(frame_skip):
-                    self.trace_tires[i].pop(0)
+            self.trace_tires[i].append((tires[i].x, tires[i].y))
     
     def _calculate_steering_rotation_point(self):
         angle = -self.heading.angle_to(Vector2(1, 0))
@@ -162,30 +203,46 @@ class CarModel:
         self._draw_grid(screen)
         self._draw_trace(screen)
         if self.draw_track_projection: self._draw_steering_radius(screen, True)
-        self._draw_tires(screen)
-        self._draw_car(screen)
+        # Body and tire polygons in screen coordinates, with one transform for all
+        body, tires = self.geometry.transform(self.render_position,
+                                              -self.render_heading.angle_to(Vector2(1, 0)),
+                                              self.steering,
+                                              np.array((self.camera_position_smooth.x, self.camera_position_smooth.y)),
+                                              self.ppu)
+        self._draw_tires(screen, tires)
+        self._draw_car(screen, body)
 
 
     def _update_camera_position(self, screen):
-        self.camera_position = self.position - (Vector2(*screen.get_rect().center) / self.ppu)
+        self.camera_position = self.render_position - (Vector2(*screen.get_rect().center) / self.ppu)
         self.camera_position_smooth = self.camera_position_smooth * 0.97 + self.camera_position * 0.03
 
     def _draw_grid(self, screen):
-        canvas_width = screen.get_width()
-        canvas_height = screen.get_height()
-    
-        # TODO: with this method about 1/2 of the grid is drawn off screen
-        start_x = int(self.camera_position_smooth.x * self.ppu) - canvas_width
-        start_y = int(self.camera_position_smooth.y * self.ppu) - canvas_height
-        stop_x = int(self.camera_position_smooth.x * self.ppu) + canvas_width
-        stop_y = int(self.camera_position_smooth.y * self.ppu) + canvas_height
-        start_x = start_x - start_x % self.ppu
-        start_y = start_y - start_y % self.ppu
-
-        for x in range(start_x, stop_x, self.ppu):
-            pg.draw.line(screen, (50, 50, 50), (x - self.camera_position_smooth.x * self.ppu, 0), (x - self.camera_position_smooth.x * self.ppu, canvas_height))
-        for y in range(start_y, stop_y, self.ppu):
-            pg.draw.line(screen, (50, 50, 50), (0, y - self.camera_position_smooth.y * self.ppu), (canvas_width, y - self.camera_position_smooth.y * self.ppu))
+        # The grid is rendered once per zoom level into an opaque surface one
+        # cell larger than the screen and blitted with the camera offset within
+        # a cell. It covers the whole screen, so it also clears the last frame
+        ppu = int(self.ppu)
+        if ppu <= 0:
+            screen.fill((30, 30, 30))
+            return
+        key = (ppu, screen.get_size())
+        if self._grid_tile_key != key:
+            self._grid_tile = self._render_grid_tile(screen, ppu)
+            self._grid_tile_key = key
+        offset_x = math.floor(-(self.camera_position_smooth.x * ppu % ppu))
+        offset_y = math.floor(-(self.camera_position_smooth.y * ppu % ppu))
+        screen.blit(self._grid_tile, (offset_x, offset_y))
+
+    def _render_grid_tile(self, screen, ppu):
+        width = screen.get_width() + ppu
+        height = screen.get_height() + ppu
+        tile = pg.Surface((width, height), 0, screen)
+        tile.fill((30, 30, 30))
+        for x in range(0, width, ppu):
+            pg.draw.line(tile, (50, 50, 50), (x, 0), (x, height))
+        for y in range(0, height, ppu):
+            pg.draw.line(tile, (50, 50, 50), (0, y), (width, y))
+        return tile
 
 
     def _draw_steering_radius(self, screen, draw_wide_track=False):
@@ -213,106 +270,50 @@ class CarModel:
         else:
             if draw_wide_track:
                 pg.draw.line(screen, color_track,
-                             (self.position  - self.camera_position_smooth) * self.ppu - self.heading * self.ppu * 100,
-                             (self.position  - self.camera_position_smooth) * self.ppu + self.heading * self.ppu * 100,
+                             (self.render_position  - self.camera_position_smooth) * self.ppu - self.render_heading * self.ppu * 100,
+                             (self.render_position  - self.camera_position_smooth) * self.ppu + self.render_heading * self.ppu * 100,
                              width)
             pg.draw.line(screen, color_line,
-                         (self.position  - self.camera_position_smooth)  * self.ppu - self.heading * self.ppu * 100,
-                         (self.position- self.camera_position_smooth) * self.ppu + self.heading * self.ppu * 100, 1)
+                         (self.render_position  - self.camera_position_smooth)  * self.ppu - self.render_heading * self.ppu * 100,
+                         (self.render_position- self.camera_position_smooth) * self.ppu + self.render_heading * self.ppu * 100, 1)
 
-    def _draw_car(self, screen):
+    def _draw_car(self, screen, body):
         # draw rectangle representing car
-        angle = -self.heading.angle_to(Vector2(1, 0))
-
-        factor_overlap = 1.5 # determines how much the car goes over the tires from the front and back
-        car_corner_points = [
-            Vector2(-self.length / factor_overlap, self.width / 2),
-            Vector2(self.length / factor_overlap, self.width / 2),
-            Vector2(self.length / factor_overlap, -self.width / 2),
-            Vector2(-self.length / factor_overlap, -self.width / 2)
-        ]
-
-        car_corner_points = [p.rotate(angle) for p in car_corner_points]
-        car_corner_points = [p + self.position for p in car_corner_points]
-        car_corner_points = [p - self.camera_position_smooth for p in car_corner_points]
-        car_corner_points = [p * self.ppu for p in car_corner_points]
-
-        pg.draw.polygon(screen, (255, 255, 255), car_corner_points, 0)
+        pg.draw.polygon(screen, (255, 255, 255), body, 0)
 
         # indicate front of car
         #pg.draw.line(screen, (255, 255, 0), self.position *  self.ppu, (self.position + self.heading) * self.ppu * 0.1, 1)
 
-    def _draw_tires(self, screen):
-        # Draw tires
-        angle = -self.heading.angle_to(Vector2(1, 0))
-        tire_width = self.width / 4
-        tire_length = self.length / 4
-
-        # Draw front tires
-        tire_corner_points = [
-            Vector2(-tire_length / 2, tire_width / 2),
-            Vector2(tire_length / 2, tire_width / 2),
-            Vector2(tire_length / 2, -tire_width / 2),
-            Vector2(-tire_length / 2, -tire_width / 2)
-        ]
-
-        tire_corner_points = [p.rotate(angle + self.steering) for p in tire_corner_points]
-        tire_corner_points = [p * self.ppu for p in tire_corner_points]
-
-        tires = [
-            Vector2(self.length / 2, self.width / 2),
-            Vector2(self.length / 2, -self.width / 2),
-        ]
-
-        tires = [p.rotate(angle) for p in tires]
-        tires = [p + self.position for p in tires]
-        tires = [p - self.camera_position_smooth for p in tires]
-        tires = [p * self.ppu for p in tires]
-
-
-        for tire in tires:
-            points = [p + tire for p in tire_corner_points]
-            pg.draw.polygon(screen, (255, 255, 255), points, 2)
-
-        # Draw rear tires
-        tire_corner_points = [
-            Vector2(-tire_length / 2, tire_width / 2),
-            Vector2(tire_length / 2, tire_width / 2),
-            Vector2(tire_length / 2, -tire_width / 2),
-            Vector2(-tire_length / 2, -tire_width / 2)
-        ]
-        tire_corner_points = [p.rotate(angle) for p in tire_corner_points]
-        tire_corner_points = [p * self.ppu for p in tire_corner_points]
-
-        tires = [
-            Vector2(-self.length / 2, self.width / 2),
-            Vector2(-self.length / 2, -self.width / 2)
-        ]
-        tires = [p.rotate(angle) for p in tires]
-        tires = [p + self.position for p in tires]
-        tires = [p - self.camera_position_smooth for p in tires]
-        tires = [p * self.ppu for p in tires]
-
+    def _draw_tires(self, screen, tires):
         for tire in tires:
-            points = [p + tire for p in tire_corner_points]
-            pg.draw.polygon(screen, (255, 255, 255), points, 2)
+            pg.draw.polygon(screen, (255, 255, 255), tire, 2)
 
     def _draw_trace(self, screen):
         if self.draw_trace:
             if len(self.trace) < 2:
                 return
-            points = [p - self.camera_position_smooth for p in self.trace]
-            points = [p * self.ppu for p in points]
-            pg.draw.lines(screen, (100,100,100), False, points, 1)
+            # Only draw the simplified trace for the current zoom inside the viewport
+            viewport_min = np.array((self.camera_position_smooth.x, self.camera_position_smooth.y))
+            viewport_max = viewport_min + np.array(screen.get_size()) / self.ppu
+            runs = self.trace_lod.visible_runs(self.ppu, viewport_min, viewport_max)
+            for points in runs:
+                pg.draw.lines(screen, (100,100,100), False, self._world_to_screen(points), 1)
+            # Connect the simplified trace to the current position
+            simplified = self.trace_lod.simplified(self.trace_lod.level_for(self.ppu))
+            last_points = np.array((simplified[-1], self.trace.points()[-1]))
+            pg.draw.line(screen, (100,100,100), *self._world_to_screen(last_points), 1)
             
 
         if self.draw_tire_trace:
-            for points in self.trace_tires:
-                if len(points) < 2:
+            for trace in self.trace_tires:
+                if len(trace) < 2:
                     continue
-                points = [p - self.camera_position_smooth for p in points]
-                points = [p * self.ppu for p in points]
-                pg.draw.lines(screen, (50,50,50), False, points, 5)
+                pg.draw.lines(screen, (50,50,50), False, self._world_to_screen(trace.points()), 5)
+
+    def _world_to_screen(self, points):
+        """Transform an (n, 2) array of world coordinates to screen pixels."""
+        camera = np.array((self.camera_position_smooth.x, self.camera_position_smooth.y))
+        return (points - camera) * self.ppu
 
     def _rotate_vector_about_point(self, vector, point, angle):
         """Rotate a vector about a point by a given angle in degrees."""
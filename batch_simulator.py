@@ -0,0 +1,151 @@
+import numpy as np
+from config import Config as cfg
+
+
+class BatchCarModel:
+    '''
+    Headless, vectorized version of the CarModel kinematics.
+
+    Simulates n cars at once, each with its own parameters and inputs. The
+    state is kept in NumPy arrays of shape (n,) and every step is a handful
+    of array operations, so thousands of cars can be stepped without pygame
+    or a display. The update order and the units are the same as in
+    CarModel.update(): dt is in model time units (see CarModel.time_scale)
+    and the heading is an angle in degrees, 0 pointing along +x.
+
+    Inputs are -1, 0 or 1 per car and step, like holding a key:
+    steering -1 = a (left), 1 = d (right), throttle 1 = w, -1 = s.
+
+    Parameters can be scalars or arrays of shape (n,), e.g. for a sweep:
+        model = BatchCarModel(1000, max_steering=np.linspace(10, 40, 1000))
+        trajectory = model.simulate(steering_inputs, throttle_inputs, dt=0.1)
+    '''
+    def __init__(self, n,
+                 max_steering=cfg.get('max_steering'),
+                 steering_speed=cfg.get('steering_speed'),
+                 max_velocity=cfg.get('max_velocity'),
+                 acceleration=cfg.get('acceleration'),
+                 car_length=cfg.get('car_length'),
+                 magic_number=cfg.get('magic_number'),
+                 rotation_position=-1):
+        self.n = n
+        self.max_steering = self._parameter(max_steering)
+        self.steering_speed = self._parameter(steering_speed)
+        self.max_velocity = self._parameter(max_velocity)
+        self.acceleration = self._parameter(acceleration)
+        self.length = self._parameter(car_length)
+        self.magic_number = self._parameter(magic_number)
+        self.rotation_position = rotation_position # 1.0 = front, -1.0 = back
+        self.reset()
+
+    def _parameter(self, value):
+        return np.broadcast_to(np.asarray(value, np.float64), (self.n,)).copy()
+
+    def reset(self, x=0.0, y=0.0, heading=-90.0, velocity=0.0, steering=0.0):
+        '''Set the state of all cars, the default heading matches CarModel'''
+        self.x = self._parameter(x)
+        self.y = self._parameter(y)
+        self.heading = self._parameter(heading)   # degrees
+        self.velocity = self._parameter(velocity) # velocity magnitude
+        self.steering = self._parameter(steering) # tire angle in degrees
+        self.steering_radius = self._steering_radius()
+
+    def state(self):
+        return {
+            'x': self.x.copy(),
+            'y': self.y.copy(),
+            'heading': self.heading.copy(),
+            'velocity': self.velocity.copy(),
+            'steering': self.steering.copy(),
+        }
+
+    def step(self, steering_input, throttle_input, dt):
+        self._update_position(dt)
+        self._update_steering(np.asarray(steering_input), dt)
+        self.steering_radius = self._steering_radius()
+        self._update_velocity(np.asarray(throttle_input), dt)
+
+    def step_commands(self, steering, throttle, dt):
+        '''
+        Step with controll commands as sent to the worker instead of key
+        inputs. Steering and throttle in [-1, 1] set the tire angle and the
+        velocity directly, see SlamcarController._update_controlls. The
+        position is integrated with the previous commands.
+        '''
+        self._update_position(dt)
+        self.set_commands(steering, throttle)
+
+    def set_commands(self, steering, throttle):
+        '''Set the tire angle and the velocity from controll commands in [-1, 1]'''
+        self.steering = np.asarray(steering) * self.max_steering
+        self.steering_radius = self._steering_radius()
+        self.velocity = np.asarray(throttle) * self.max_velocity
+
+    def simulate(self, steering_inputs, throttle_inputs, dt):
+        '''
+        Run len(steering_inputs) steps with inputs of shape (steps, n) or
+        (steps,) for the same inputs on all cars. Returns a dict of arrays of
+        shape (steps + 1, n) with the state before the first and after every
+        step.
+        '''
+        steering_inputs = np.asarray(steering_inputs)
+        throttle_inputs = np.asarray(throttle_inputs)
+        steps = len(steering_inputs)
+        trajectory = {key: np.empty((steps + 1, self.n)) for key in self.state()}
+        for key, value in self.state().items():
+            trajectory[key][0] = value
+        for i in range(steps):
+            self.step(steering_inputs[i], throttle_inputs[i], dt)
+            for key, value in self.state().items():
+                trajectory[key][i + 1] = value
+        return trajectory
+
+    def _steering_radius(self):
+        with np.errstate(divide='ignore'):
+            radius = self.length / np.tan(np.radians(self.steering))
+        return np.where(self.steering == 0, 0.0, radius)
+
+    def _update_position(self, dt):
+        heading = np.radians(self.heading)
+        heading_x, heading_y = np.cos(heading), np.sin(heading)
+        straight = np.abs(self.steering) < 0.01
+
+        # Point around which the car is rotating, see CarModel._calculate_steering_rotation_point
+        radius = self.steering_radius
+        center_x = self.x - radius * heading_y + self.rotation_position * heading_x * self.length / 2
+        center_y = self.y + radius * heading_x + self.rotation_position * heading_y * self.length / 2
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            rotation = np.where(straight, 0.0, self.velocity / radius * dt) # degrees
+        cos, sin = np.cos(np.radians(rotation)), np.sin(np.radians(rotation))
+        relative_x, relative_y = self.x - center_x, self.y - center_y
+        turned_x = center_x + cos * relative_x - sin * relative_y
+        turned_y = center_y + sin * relative_x + cos * relative_y
+
+        distance = self.velocity * dt * self.magic_number
+        self.x = np.where(straight, self.x + heading_x * distance, turned_x)
+        self.y = np.where(straight, self.y + heading_y * distance, turned_y)
+        self.heading = self.heading + rotation
+
+    def _update_steering(self, steering_input, dt):
+        change = self.steering_speed * dt
+        steering = np.where(steering_input < 0, np.maximum(-self.max_steering, self.steering - change), self.steering)
+        steering = np.where(steering_input > 0, np.minimum(self.max_steering, steering + change), steering)
+
+        # Without input the steering goes back to 0 twice as fast
+        back_steer_factor = 2
+        centered = np.where(steering > 0,
+                            np.maximum(0, steering - change * back_steer_factor),
+                            np.minimum(0, steering + change * back_steer_factor))
+        self.steering = np.where(steering_input == 0, centered, steering)
+
+    def _update_velocity(self, throttle_input, dt):
+        change = self.acceleration * dt
+        velocity = np.where(throttle_input > 0, np.minimum(self.max_velocity, self.velocity + change), self.velocity)
+        velocity = np.where(throttle_input < 0, np.maximum(-self.max_velocity, velocity - change), velocity)
+
+        # Without input the car rolls out to 0
+        rolled_out = np.where(velocity > 0,
+                              np.maximum(0, velocity - change),
+                              np.minimum(0, velocity + change))
+        self.velocity = np.where(throttle_input == 0, rolled_out, velocity)
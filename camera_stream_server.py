@@ -1,54 +1,388 @@
 import zmq
+import time
+import asyncio
 import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from queue import Queue
 import numpy as np
-from PIL import Image
-import io
 import logging
 from config import Config as cfg
+from image_decoder import create_decoder
+from frame_protocol import unpack_frame
+from stream_stats import ThroughputCounter, FrameStats, StreamHealth, worker_name
 
 class CameraStreamServer:
     ''''
     This is a implementation of a ZMQ image stream receiver for the SlamCar project.
     '''
-    def __init__(self, port=cfg.get('image_stream_port')):
+    # Transport modes selectable with the 'image_stream_mode' config key.
+    # 'reqrep' answers every frame with OK/ERROR (worker waits for the reply),
+    # 'pushpull' and 'pubsub' let the worker stream without waiting.
+    SOCKET_TYPES = {
+        'reqrep': zmq.REP,
+        'pushpull': zmq.PULL,
+        'pubsub': zmq.SUB,
+    }
+
+    def __init__(self, port=cfg.get('image_stream_port'), queue_size=cfg.get('image_queue_size'),
+                 mode=cfg.get('image_stream_mode'),
+                 hwm=cfg.get('image_stream_hwm'),
+                 conflate=cfg.get('image_stream_conflate'),
+                 decoder=cfg.get('image_decoder'),
+                 preview_scale=cfg.get('preview_decode_scale'),
+                 decode_workers=cfg.get('image_decode_workers'),
+                 context=None):
+        if mode not in self.SOCKET_TYPES:
+            raise ValueError(f'Unknown image stream mode {mode}')
         self.host = '0.0.0.0'
         self.port = port
-        self.context = zmq.Context()
-        self.socket = self.context.socket(zmq.REP)
+        self.mode = mode
+        # A zmq.asyncio.Context can be passed in to run the server on an
+        # event loop, see receive_loop_async and async_core.py
+        self._own_context = context is None
+        self.context = zmq.Context() if context is None else context
+        self.socket = self.context.socket(self.SOCKET_TYPES[mode])
+        # Socket options have to be set before binding
+        if mode != 'reqrep':
+            self.socket.setsockopt(zmq.RCVHWM, int(hwm))
+            if conflate:
+                # Only keep the most recent message in the socket queue
+                self.socket.setsockopt(zmq.CONFLATE, 1)
+        if mode == 'pubsub':
+            self.socket.setsockopt(zmq.SUBSCRIBE, b'')
         self.socket.bind(f"tcp://{self.host}:{self.port}")
-        self.queue = Queue()
+        # Bounded frame buffer. When it is full the oldest frame is dropped,
+        # so with a size of 1 the consumer always gets the latest frame.
+        self.queue = deque(maxlen=max(1, int(queue_size)))
+        self.queue_lock = threading.Lock()
+        self.dropped_frames = 0 # frames discarded because the consumer was too slow
+        self.frame_stats = FrameStats() # latency and lost frames from the frame headers
+        self.recorder = None # set to a SessionRecorder to record the incoming frames
+        self.health = StreamHealth() # arrival jitter and decode times
+        self.decode_workers = max(1, int(decode_workers))
         self._thread = threading.Thread(target=self._receive_loop, daemon=True)
+        self._stop_event = threading.Event() # ends the receive thread, see close()
+        self.poll_timeout = 100 # milliseconds the receive thread waits before checking _stop_event
+
+        # With more than one decode worker the receive thread only pulls bytes
+        # off the socket and hands them to a thread pool. The futures are kept
+        # in arrival order, so the delivery thread puts frames into the queue
+        # in the same order they were received.
+        self._executor = None
+        if self.decode_workers > 1:
+            self._executor = ThreadPoolExecutor(max_workers=self.decode_workers,
+                                                thread_name_prefix='image_decode')
+            self._pending = Queue(maxsize=2 * self.decode_workers)
+            self._deliver_thread = threading.Thread(target=self._deliver_loop, daemon=True)
+        # Queued frames are always decoded at full resolution, SLAM is
+        # calibrated for it. The preview decodes the newest frame at its own
+        # scale, only when it is shown, see receive_preview
+        self.decoder = create_decoder(decoder, buffers=self._decode_buffers())
+        self.preview_scale = int(preview_scale)
+        self.preview_decoder = create_decoder(decoder, scale=self.preview_scale, buffers=2)
+        self._preview_jpeg = None # JPEG bytes of the newest frame, not yet decoded for the preview
 
-    def start(self):
-        self._thread.start()
-        print(f"Image Stream: Listening at {self.host}:{self.port}")
+    def start(self, receive_thread=True):
+        if receive_thread:
+            self._thread.start()
+        if self._executor is not None:
+            self._deliver_thread.start()
+        print(f"Image Stream: Listening at {self.host}:{self.port} ({self.mode})")
 
     def receive_image(self):
-        if not self.queue.empty():
-            return self.queue.get()
-        else:
+        frame = self.receive_frame()
+        if frame is not None:
+            return frame[0]
+        return None
+
+    def receive_frame(self):
+        '''Return the next frame as (image, FrameHeader) or None'''
+        with self.queue_lock:
+            if self.queue:
+                return self.queue.popleft()
+            else:
+                return None
+
+    def receive_preview(self):
+        '''
+        Decode the newest frame at preview_scale for displaying, returns None
+        if no frame arrived since the last call. The image is only valid
+        until the next call.
+        '''
+        with self.queue_lock:
+            jpeg, self._preview_jpeg = self._preview_jpeg, None
+        if jpeg is None:
             return None
+        return self.preview_decoder.decode(jpeg)
+
+    def queue_depth(self):
+        '''Number of frames waiting to be decoded or consumed'''
+        depth = len(self.queue)
+        if self._executor is not None:
+            depth += self._pending.qsize()
+        return depth
+
+    def get_frame_stats(self):
+        with self.queue_lock:
+            return self.frame_stats.as_dict()
+
+    def _put_image(self, img, header, worker=None):
+        with self.queue_lock:
+            self.frame_stats.add(header)
+            if len(self.queue) == self.queue.maxlen:
+                self.dropped_frames += 1
+            self.queue.append((img, header))
+
+    def _decoder_for(self, worker):
+        return self.decoder
+
+    def _decode_buffers(self):
+        # Decoded frames are written into a ring of reused buffers. It must be
+        # larger than the queue plus the frames the consumer holds on to
+        # (last preview image and the one currently being processed) plus the
+        # frames being decoded at the same time. With a decode pool, decoded
+        # frames also wait in _pending, one in the blocked put() and one in
+        # the delivery thread.
+        buffers = self.queue.maxlen + 3 + self.decode_workers
+        if self._executor is not None:
+            buffers += self._pending.maxsize + 2
+        return buffers
 
     def close(self):
         print("Closing socket")
-        self.socket.close()
-        self.context.term()
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+        # ZMQ sockets are not thread safe, so the receive thread closes its
+        # socket itself. Without it (async core) close() runs on the socket's thread
+        self._stop_event.set()
+        if self._thread.is_alive():
+            self._thread.join()
+        else:
+            self.socket.close(linger=0)
+        if self._own_context:
+            self.context.term()
         
     def _receive_loop(self):
+        while not self._stop_event.is_set():
+            if self.socket.poll(self.poll_timeout):
+                message = self.socket.recv()
+                self._reply(self._on_message(message))
+        self.socket.close(linger=0)
+
+    async def receive_loop_async(self):
+        '''Receive loop for a socket created from a zmq.asyncio.Context'''
+        while True:
+            message = await self.socket.recv()
+            # Decoding would block the event loop, so it runs on a thread
+            try:
+                reply = await asyncio.to_thread(self._on_message, message)
+            except Exception as e:
+                logging.warning(f'Image Stream: could not handle frame: {e!r}')
+                reply = b'ERROR'
+            if self.mode == 'reqrep':
+                await self.socket.send(reply)
+
+    def feed(self, message, worker=None):
+        '''
+        Handle a frame message as if it was received from the socket and
+        return the reply, e.g. for replaying a recorded session
+        '''
+        return self._on_message(message)
+
+    def _on_message(self, message):
+        self.health.add_arrival()
+        try:
+            if self.recorder is not None:
+                self.recorder.record_frame(message)
+            self._handle_frame(message)
+            return b'OK'
+        except:
+            return b'ERROR'
+
+    def _handle_frame(self, message, worker=None):
+        # Extract the frame header and the image bytes
+        header, img_bytes = unpack_frame(message)
+        self._keep_preview(img_bytes, worker)
+        decoder = self._decoder_for(worker)
+        if self._executor is None:
+            # Convert the bytes to an image
+            img = self._decode(decoder, img_bytes)
+            # Put the image in the queue for the main thread to consume
+            self._put_image(img, header, worker)
+        else:
+            # Blocks when the decoders fall behind, the socket's
+            # high-water mark then limits how much piles up
+            self._pending.put((worker, header, self._executor.submit(self._decode, decoder, img_bytes)))
+
+    def _keep_preview(self, img_bytes, worker=None):
+        if self.preview_scale != 1:
+            with self.queue_lock:
+                self._preview_jpeg = img_bytes
+
+    def _decode(self, decoder, img_bytes):
+        start = time.perf_counter()
+        img = decoder.decode(img_bytes)
+        self.health.add_decode_time(time.perf_counter() - start)
+        return img
+
+    def _deliver_loop(self):
+        while True:
+            worker, header, future = self._pending.get()
+            try:
+                self._put_image(future.result(), header, worker)
+            except Exception as e:
+                logging.warning(f'Image Stream: could not decode frame: {e}')
+
+    def _reply(self, message):
+        # Only REP sockets have to (and can) answer the worker
+        if self.mode == 'reqrep':
+            self.socket.send(message)
+
+
+
+class RouterCameraStreamServer(CameraStreamServer):
+    '''
+    Image stream receiver for several workers on one port. Uses a ROUTER
+    socket and keeps a separate frame queue, decoder and throughput counter
+    for every worker, keyed by the worker's socket identity. Workers can
+    connect with REQ (they get an OK/ERROR reply) or DEALER sockets.
+    '''
+    SOCKET_TYPES = {
+        'router': zmq.ROUTER,
+    }
+
+    def __init__(self, port=cfg.get('image_stream_port'), queue_size=cfg.get('image_queue_size'),
+                 hwm=cfg.get('image_stream_hwm'),
+                 decoder=cfg.get('image_decoder'),
+                 preview_scale=cfg.get('preview_decode_scale'),
+                 decode_workers=cfg.get('image_decode_workers'),
+                 context=None):
+        # CONFLATE does not work with the multipart messages of a ROUTER socket
+        super().__init__(port=port, queue_size=queue_size, mode='router', hwm=hwm,
+                         conflate=False, decoder=decoder, preview_scale=preview_scale,
+                         decode_workers=decode_workers, context=context)
+        self._decoder_name = decoder
+        self.workers = {} # identity -> per worker state, see _get_worker
+
+    def _get_worker(self, identity):
+        # Only called from the receive thread, other threads just read
+        with self.queue_lock:
+            if identity not in self.workers:
+                print(f"Image Stream: Worker {worker_name(identity)} connected")
+                self.workers[identity] = {
+                    'queue': deque(maxlen=self.queue.maxlen),
+                    'dropped_frames': 0,
+                    'throughput': ThroughputCounter(),
+                    'frame_stats': FrameStats(),
+                    'decoder': create_decoder(self._decoder_name, buffers=self._decode_buffers()),
+                    'preview_jpeg': None,
+                }
+            return self.workers[identity]
+
+    def get_workers(self):
+        with self.queue_lock:
+            return list(self.workers.keys())
+
+    def queue_depth(self):
+        '''Frames waiting in the fullest worker queue plus the frames waiting to be decoded'''
+        with self.queue_lock:
+            depth = max((len(w['queue']) for w in self.workers.values()), default=0)
+        if self._executor is not None:
+            depth += self._pending.qsize()
+        return depth
+
+    def receive_image(self, worker=None):
+        frame = self.receive_frame(worker)
+        if frame is not None:
+            return frame[0]
+        return None
+
+    def receive_frame(self, worker=None):
+        '''Return the next (image, FrameHeader) of the given worker, or of the first worker if None'''
+        with self.queue_lock:
+            if worker is None:
+                if not self.workers:
+                    return None
+                worker = next(iter(self.workers))
+            if worker not in self.workers:
+                return None
+            queue = self.workers[worker]['queue']
+            if queue:
+                return queue.popleft()
+            return None
+
+    def receive_preview(self, worker=None):
+        '''Like CameraStreamServer.receive_preview, for the given worker or the first one if None'''
+        with self.queue_lock:
+            if worker is None:
+                if not self.workers:
+                    return None
+                worker = next(iter(self.workers))
+            if worker not in self.workers:
+                return None
+            w = self.workers[worker]
+            jpeg, w['preview_jpeg'] = w['preview_jpeg'], None
+        if jpeg is None:
+            return None
+        return self.preview_decoder.decode(jpeg)
+
+    def get_worker_stats(self):
+        '''Throughput and drop counters of every worker, keyed by worker name'''
+        with self.queue_lock:
+            return {worker_name(identity): {**w['throughput'].as_dict(),
+                                            **w['frame_stats'].as_dict(),
+                                            'dropped_frames': w['dropped_frames']}
+                    for identity, w in self.workers.items()}
+
+    def _put_image(self, img, header, worker=None):
+        with self.queue_lock:
+            w = self.workers[worker]
+            w['frame_stats'].add(header)
+            if len(w['queue']) == w['queue'].maxlen:
+                w['dropped_frames'] += 1
+                self.dropped_frames += 1
+            w['queue'].append((img, header))
+
+    def _keep_preview(self, img_bytes, worker=None):
+        if self.preview_scale != 1:
+            with self.queue_lock:
+                self.workers[worker]['preview_jpeg'] = img_bytes
+
+    def _decoder_for(self, worker):
+        return self.workers[worker]['decoder']
+
+    def _receive_loop(self):
+        while not self._stop_event.is_set():
+            if self.socket.poll(self.poll_timeout):
+                frames = self.socket.recv_multipart()
+                self.socket.send_multipart(self._on_frames(frames))
+        self.socket.close(linger=0)
+
+    async def receive_loop_async(self):
         while True:
-            message = self.socket.recv()
+            frames = await self.socket.recv_multipart()
             try:
-                # Extract the size of the message and the image bytes
-                size = int.from_bytes(message[:4], byteorder='big')
-                img_bytes = message[4:4+size]
-                # Convert the bytes to an image
-                img = Image.open(io.BytesIO(img_bytes))
-                img = np.array(img)
-                # Put the image in the queue for the main thread to consume
-                self.queue.put(img)
-
-                self.socket.send(b'OK')
-            except:
-                self.socket.send(b'ERROR')
+                reply = await asyncio.to_thread(self._on_frames, frames)
+            except Exception as e:
+                logging.warning(f'Image Stream: could not handle frame: {e!r}')
+                reply = frames[:-1] + [b'ERROR']
+            await self.socket.send_multipart(reply)
+
+    def feed(self, message, worker=b'replay'):
+        '''Handle a frame message as if `worker` had sent it, returns the reply'''
+        return self._on_frames([worker, message])[-1]
 
+    def _on_frames(self, frames):
+        # [identity, (empty delimiter from REQ,) payload]
+        envelope, message = frames[:-1], frames[-1]
+        identity = envelope[0]
+        w = self._get_worker(identity)
+        w['throughput'].add(len(message))
+        try:
+            if self.recorder is not None:
+                self.recorder.record_frame(message)
+            self._handle_frame(message, identity)
+            return envelope + [b'OK']
+        except:
+            return envelope + [b'ERROR']
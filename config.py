@@ -1,20 +1,134 @@
-
+import atexit
+import copy
+import contextlib
 import json
+import os
+import threading
+import time
+
 class Config:
-    @staticmethod
-    def get(key):
-        config = json.load(open('config.json', 'r'))
+    # The parsed config is kept in memory and only re-read when config.json
+    # changes on disk. The modification time is checked at most every
+    # _check_interval seconds, so frequent get() calls cost no disk I/O.
+    #
+    # Changes are applied to the in-memory config right away and written to
+    # disk by a timer thread once no further change happened for _write_delay
+    # seconds. The file is replaced atomically, so readers never see a
+    # half-written config.
+    _path = 'config.json'
+    _check_interval = 0.5
+    _write_delay = 0.5
+    _config = None
+    _mtime = None
+    _last_check = 0.0
+    _dirty = False          # in-memory config has changes not yet on disk
+    _transaction_depth = 0  # > 0 while inside Config.transaction()
+    _write_timer = None
+    _lock = threading.RLock()
+
+    @classmethod
+    def _load(cls):
+        now = time.monotonic()
+        if cls._config is not None and now - cls._last_check < cls._check_interval:
+            return cls._config
+        with cls._lock:
+            cls._last_check = now
+            # Don't overwrite changes that are still waiting to be written
+            if cls._config is not None and cls._dirty:
+                return cls._config
+            try:
+                mtime = os.stat(cls._path).st_mtime_ns
+            except FileNotFoundError:
+                if cls._config is not None:
+                    return cls._config
+                raise
+            if cls._config is None or mtime != cls._mtime:
+                with open(cls._path, 'r') as f:
+                    cls._config = json.load(f)
+                cls._mtime = mtime
+            return cls._config
+
+    @classmethod
+    def _write(cls, config):
+        # Write to a temporary file next to config.json and rename it over the
+        # original, which is atomic on both POSIX and Windows
+        tmp_path = cls._path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(config, f, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, cls._path)
+        cls._mtime = os.stat(cls._path).st_mtime_ns
+
+    @classmethod
+    def _mark_dirty(cls):
+        cls._dirty = True
+        if cls._transaction_depth > 0:
+            return
+        # Restart the timer so rapid edits are coalesced into one write
+        if cls._write_timer is not None:
+            cls._write_timer.cancel()
+        cls._write_timer = threading.Timer(cls._write_delay, cls.flush)
+        cls._write_timer.daemon = True
+        cls._write_timer.start()
+
+    @classmethod
+    def flush(cls):
+        '''Write pending changes to config.json immediately'''
+        with cls._lock:
+            if cls._write_timer is not None:
+                cls._write_timer.cancel()
+                cls._write_timer = None
+            if not cls._dirty:
+                return
+            cls._write(cls._config)
+            cls._dirty = False
+
+    @classmethod
+    @contextlib.contextmanager
+    def transaction(cls):
+        '''
+        Group several set()/add() calls into a single write. If the block
+        raises, all changes made inside it are rolled back.
+        '''
+        with cls._lock:
+            snapshot = copy.deepcopy(cls._load())
+            was_dirty = cls._dirty
+            cls._transaction_depth += 1
+            try:
+                yield cls
+            except:
+                cls._config = snapshot
+                cls._dirty = was_dirty
+                raise
+            finally:
+                cls._transaction_depth -= 1
+            if cls._dirty:
+                cls._mark_dirty()
+
+    @classmethod
+    def reload(cls):
+        '''Force the next read to parse config.json again'''
+        with cls._lock:
+            cls._config = None
+            cls._last_check = 0.0
+
+    @classmethod
+    def get(cls, key):
+        config = cls._load()
         if key in config:
-            return config[key]
+            return copy.deepcopy(config[key])
 
         for _, conf  in config.items():
             if key in conf:
-                return conf[key]
-            
+                value = conf[key]
+                # Hand out copies of lists so callers can't alter the cache
+                return copy.deepcopy(value) if isinstance(value, list) else value
+
         raise KeyError(f'Key {key} not found in config')
-        
-    @staticmethod
-    def set(key, value):
+
+    @classmethod
+    def set(cls, key, value):
         set_value = value
         # Check if value is a string that can be converted to a number
         if type(value) == str:
@@ -24,38 +138,43 @@ class Config:
                     set_value = int(set_value)
             except:
                 pass
-        config = json.load(open('config.json', 'r'))
-        for _, conf  in config.items():
-            if key in conf:
-                conf[key] = set_value
-                json.dump(config, open('config.json', 'w'), indent=2)
-                return
-            
+        with cls._lock:
+            config = cls._load()
+            for _, conf  in config.items():
+                if key in conf:
+                    conf[key] = set_value
+                    cls._mark_dirty()
+                    return
+
         raise KeyError(f'Key {key} not found in config')
 
-    @staticmethod
-    def add(group, key, value):
-        config = json.load(open('config.json', 'r'))
-        if group in config:
-            if key in config[group]:
-                raise KeyError(f'Key {key} already exists in config')
-            config[group][key] = value
-            json.dump(config, open('config.json', 'w'), indent=2)
-            return
+    @classmethod
+    def add(cls, group, key, value):
+        with cls._lock:
+            config = cls._load()
+            if group in config:
+                if key in config[group]:
+                    raise KeyError(f'Key {key} already exists in config')
+                config[group][key] = value
+                cls._mark_dirty()
+                return
         raise KeyError(f'Group {group} not found in config')
 
-    @staticmethod
-    def get_groups():
-        config = json.load(open('config.json', 'r'))
+    @classmethod
+    def get_groups(cls):
+        config = cls._load()
         return list(config.keys())
-    
-    @staticmethod
-    def get_keys(group):
-        config = json.load(open('config.json', 'r'))
+
+    @classmethod
+    def get_keys(cls, group):
+        config = cls._load()
         if group in config:
             return list(config[group].keys())
         raise KeyError(f'Group {group} not found in config')
 
+# Make sure debounced changes are not lost when the program exits
+atexit.register(Config.flush)
+
 
 from config import Config as cfg
 
@@ -66,6 +185,6 @@ if __name__ == '__main__':
     keys = cfg.get_keys(groups[0])
     print(keys)
 
-    
+
 
 
@@ -0,0 +1,122 @@
+'''
+Wire format of the controll stream.
+
+Workers can talk JSON (the original protocol) or a compact binary framing.
+The format is negotiated per message: binary messages start with MAGIC,
+which can never be the first byte of a JSON object, and the controller
+always answers in the format of the request.
+
+Binary messages (big endian):
+    STATE               [MAGIC][type][throttle: float32][steering: float32]
+    STATE_STAMPED       like STATE, followed by [stamp: float64][stamp hold: float32]
+    STATE_ACK           like STATE_STAMPED, followed by [config ack: uint32]
+In both stamped types the stamp is NaN if the worker has none to echo yet.
+    CONTROLLS           [MAGIC][type][throttle: float32][steering: float32]
+    CONTROLLS_CONFIG    like CONTROLLS, followed by the config as JSON
+    CONTROLLS_STAMPED   like CONTROLLS, followed by [stamp: float64] and
+                        optionally the config as JSON
+
+The config is rarely sent, so it gets its own message type and the
+frequent messages stay fixed size. The stamp is the controller's clock at
+the time of the reply; a worker that echoes it in STATE_STAMPED (or as
+'stamp'/'stamp_hold' in JSON) lets the controller measure the round trip
+time, see stream_stats.ControllTiming. Whether a binary worker gets
+stamped replies depends on the message type and not on the stamp, so a
+worker that starts without a stamp gets one to echo with the first reply.
+Workers that send plain STATE get unstamped replies. 'config_ack' is the version of the last
+config delta the worker applied, see controll_stream_server.ConfigSync.
+'''
+
+import json
+import math
+import struct
+
+MAGIC = 0xC5
+MSG_STATE = 0x01
+MSG_CONTROLLS = 0x02
+MSG_CONTROLLS_CONFIG = 0x03
+MSG_STATE_STAMPED = 0x04
+MSG_CONTROLLS_STAMPED = 0x05
+MSG_STATE_ACK = 0x06
+
+_MESSAGE = struct.Struct('>BBff')
+_STATE_STAMP = struct.Struct('>df')
+_CONTROLLS_STAMP = struct.Struct('>d')
+_CONFIG_ACK = struct.Struct('>I')
+
+
+def is_binary(message: bytes) -> bool:
+    return len(message) > 0 and message[0] == MAGIC
+
+
+def encode_state(state: dict) -> bytes:
+    '''
+    Used by the worker to send its state. It is stamped if it contains the
+    key 'stamp', a stamp of None means there is nothing to echo yet.
+    '''
+    stamp = state.get('stamp')
+    stamp = _STATE_STAMP.pack(math.nan if stamp is None else stamp, state.get('stamp_hold', 0.0))
+    if state.get('config_ack') is not None:
+        return (_MESSAGE.pack(MAGIC, MSG_STATE_ACK, state['throttle'], state['steering'])
+                + stamp + _CONFIG_ACK.pack(state['config_ack']))
+    if 'stamp' not in state:
+        return _MESSAGE.pack(MAGIC, MSG_STATE, state['throttle'], state['steering'])
+    return _MESSAGE.pack(MAGIC, MSG_STATE_STAMPED, state['throttle'], state['steering']) + stamp
+
+
+def decode_state(message: bytes):
+    '''
+    Decode a state message in either format, returns (state, is_binary,
+    stamped) where stamped tells if the worker wants stamped replies
+    '''
+    if not is_binary(message):
+        return json.loads(message), False, True
+    _, msg_type, throttle, steering = _MESSAGE.unpack_from(message)
+    state = {'throttle': throttle, 'steering': steering}
+    if msg_type in (MSG_STATE_STAMPED, MSG_STATE_ACK):
+        stamp, stamp_hold = _STATE_STAMP.unpack_from(message, _MESSAGE.size)
+        if not math.isnan(stamp):
+            state['stamp'], state['stamp_hold'] = stamp, stamp_hold
+        if msg_type == MSG_STATE_ACK:
+            state['config_ack'], = _CONFIG_ACK.unpack_from(message, _MESSAGE.size + _STATE_STAMP.size)
+    elif msg_type != MSG_STATE:
+        raise ValueError(f'Unexpected controll message type {msg_type}')
+    return state, True, msg_type in (MSG_STATE_STAMPED, MSG_STATE_ACK)
+
+
+def encode_reply(package: dict, binary: bool, stamped: bool=False) -> bytes:
+    '''
+    Encode a {"controlls": ..., "config": ..., "stamp": ...} package for the
+    worker. In binary the stamp is only included if stamped is set.
+    '''
+    if not binary:
+        return json.dumps(package).encode('utf-8')
+    controlls = package['controlls']
+    config = package['config']
+    if stamped:
+        message = (_MESSAGE.pack(MAGIC, MSG_CONTROLLS_STAMPED, controlls['throttle'], controlls['steering'])
+                   + _CONTROLLS_STAMP.pack(package['stamp']))
+    elif config is False:
+        return _MESSAGE.pack(MAGIC, MSG_CONTROLLS, controlls['throttle'], controlls['steering'])
+    else:
+        message = _MESSAGE.pack(MAGIC, MSG_CONTROLLS_CONFIG, controlls['throttle'], controlls['steering'])
+    if config is not False:
+        message += json.dumps(config).encode('utf-8')
+    return message
+
+
+def decode_reply(message: bytes) -> dict:
+    '''Used by the worker to decode the controller's reply'''
+    if not is_binary(message):
+        return json.loads(message)
+    _, msg_type, throttle, steering = _MESSAGE.unpack_from(message)
+    package = {'controlls': {'throttle': throttle, 'steering': steering}, 'config': False}
+    config_start = _MESSAGE.size
+    if msg_type == MSG_CONTROLLS_STAMPED:
+        package['stamp'], = _CONTROLLS_STAMP.unpack_from(message, _MESSAGE.size)
+        config_start += _CONTROLLS_STAMP.size
+    elif msg_type not in (MSG_CONTROLLS, MSG_CONTROLLS_CONFIG):
+        raise ValueError(f'Unexpected controll message type {msg_type}')
+    if len(message) > config_start:
+        package['config'] = json.loads(message[config_start:])
+    return package
@@ -1,22 +1,103 @@
 import zmq
+import time
+import logging
 import threading
-from queue import Queue
 import numpy as np
 from PIL import Image
 from config import Config as cfg
+from stream_stats import ThroughputCounter, ControllTiming, worker_name
+from controll_protocol import decode_state, encode_reply
+from telemetry import TelemetryStore
+
+
+class ConfigSync:
+    '''
+    Sends config changes to the worker as deltas. Changes made with update()
+    are merged into one pending delta that only holds keys whose value
+    differs from what the worker has (or is about to get). Each delta that
+    is sent gets a version number.
+
+    Workers that report the last applied version as 'config_ack' in their
+    state get {"version": ..., "values": {...}} and the delta is repeated
+    every resend_interval seconds until it is acknowledged. They apply a
+    version only once. Older workers don't ack; they get the values as a
+    plain dict, which counts as acknowledged as soon as it is sent.
+    '''
+    def __init__(self, resend_interval=0.5):
+        self.resend_interval = resend_interval
+        self.acked = {}         # values the worker has applied
+        self.pending = {}       # merged changes that were not sent yet
+        self.version = 0        # version of the last delta that was sent
+        self.in_flight = None   # (version, values) waiting for an ack
+        self._last_sent = 0.0
+
+    def update(self, config):
+        # Compare against what the worker will have once the delta in flight is applied
+        expected = dict(self.acked)
+        if self.in_flight is not None:
+            expected.update(self.in_flight[1])
+        for key, value in config.items():
+            if key in expected and expected[key] == value:
+                self.pending.pop(key, None)
+            else:
+                self.pending[key] = value
+
+    def reset(self):
+        '''
+        Forget what the worker has applied, e.g. after it restarted with its
+        defaults. Everything it had or was about to get goes out again as
+        one full delta.
+        '''
+        resend = dict(self.acked)
+        if self.in_flight is not None:
+            resend.update(self.in_flight[1])
+            self.in_flight = None
+        resend.update(self.pending)
+        self.acked = {}
+        self.pending = resend
+
+    def acknowledge(self, version):
+        if self.in_flight is not None and version is not None and version >= self.in_flight[0]:
+            self.acked.update(self.in_flight[1])
+            self.in_flight = None
+
+    def next_message(self, acks_supported, now=None):
+        '''Return the config to put into the next reply, or False'''
+        if now is None:
+            now = time.monotonic()
+        if self.in_flight is None and self.pending:
+            self.version += 1
+            self.in_flight = (self.version, self.pending)
+            self.pending = {}
+        elif self.in_flight is None or now - self._last_sent < self.resend_interval:
+            return False
+        self._last_sent = now
+        version, values = self.in_flight
+        if not acks_supported:
+            self.acknowledge(version)
+            return dict(values)
+        return {'version': version, 'values': values}
 
 
 class ControllStreamServer:
     ''''
     This is a implementation of a ZMQ image stream receiver for the SlamCar project.
     '''
-    def __init__(self, port=cfg.get('controll_port')):
+    SOCKET_TYPE = zmq.REP
+
+    def __init__(self, port=cfg.get('controll_port'), context=None,
+                 frequency=cfg.get('controll_frequency'), reconnect_timeout=2.0):
         self.host = '0.0.0.0'
         self.port = port
-        self.context = zmq.Context()
-        self.socket = self.context.socket(zmq.REP)
+        # A zmq.asyncio.Context can be passed in to run the server on an
+        # event loop, see communication_loop_async and async_core.py
+        self._own_context = context is None
+        self.context = zmq.Context() if context is None else context
+        self.socket = self.context.socket(self.SOCKET_TYPE)
         self.socket.bind(f"tcp://{self.host}:{self.port}")
         self._thread = threading.Thread(target=self._communication_loop, daemon=True)
+        self._stop_event = threading.Event() # ends the communication thread, see close()
+        self.poll_timeout = 100 # milliseconds the thread waits before checking _stop_event
         self.controlls = { # the controlls for the car
             'throttle': 10,
             'steering': 0
@@ -25,48 +106,316 @@ class ControllStreamServer:
             'throttle': 0,
             'steering': 0,
         }
-        self.config_queue = Queue() # the config queue
+        self.config_sync = ConfigSync() # pending config changes for the worker
+        self._worker_acks_config = False # worker reports 'config_ack'
+        self.reconnect_timeout = reconnect_timeout # seconds without state after which the worker counts as restarted
+        self._last_message = None
+        self.recorder = None # set to a SessionRecorder to record state and controlls
+        self.frequency = frequency
+        self.timing = ControllTiming(frequency) # round trip time, jitter and missed deadlines
+        self.telemetry = TelemetryStore() # history of the state messages
         
         self.controll_lock = threading.Lock()
         self.state_lock = threading.Lock()
 
-    def start(self):
-        self._thread.start()
+    def start(self, communication_thread=True):
+        if communication_thread:
+            self._thread.start()
         print(f"Controll Stream: Listening at {self.host}:{self.port}")
 
     def close(self):
         print("Closing socket")
-        self.socket.close()
-        self.context.term()
+        # ZMQ sockets are not thread safe, so the communication thread closes
+        # its socket itself. Without it (async core) close() runs on the socket's thread
+        self._stop_event.set()
+        if self._thread.is_alive():
+            self._thread.join()
+        else:
+            self.socket.close(linger=0)
+        if self._own_context:
+            self.context.term()
         
     def _communication_loop(self):
+        while not self._stop_event.is_set():
+            if self.socket.poll(self.poll_timeout):
+                message = self.socket.recv()
+                self.socket.send(self._on_bytes(message))
+        self.socket.close(linger=0)
+
+    async def communication_loop_async(self):
+        '''Communication loop for a socket created from a zmq.asyncio.Context'''
         while True:
-            message = self.socket.recv_json()
-
-            with self.state_lock:
-                self.state = message
-
-            with self.controll_lock:
-                if not self.config_queue.empty():
-                    config = self.config_queue.get()
-                    package = {
-                        "controlls": self.controlls,
-                        "config": config
-                    }
-                    self.socket.send_json(package)
-                else:
-                    package = {
-                        "controlls": self.controlls,
-                        "config": False
-                    }
-                    self.socket.send_json(package)
+            message = await self.socket.recv()
+            await self.socket.send(self._on_bytes(message))
+
+    def get_timing_stats(self):
+        with self.state_lock:
+            return self.timing.as_dict()
+
+    def feed(self, message, worker=None):
+        '''
+        Handle a state message as if it was received from the socket and
+        return the reply, e.g. for replaying a recorded session
+        '''
+        return self._on_bytes(message)
+
+    def _on_bytes(self, message):
+        # A malformed message must not end the communication loop
+        try:
+            return self._handle_bytes(message)
+        except Exception as e:
+            logging.warning(f'Controll Stream: could not handle message: {e!r}')
+            return b'ERROR'
+
+    def _handle_bytes(self, message):
+        # Answer in the format (JSON or binary) the worker used, and only
+        # stamp binary replies for workers that send stamped states
+        state, binary, stamped = decode_state(message)
+        return encode_reply(self._handle_message(state), binary, stamped=stamped)
+
+    def _handle_message(self, message):
+        if self.recorder is not None:
+            self.recorder.record_state(message)
+
+        with self.state_lock:
+            self.timing.add(message)
+            self.state = message
+        self.telemetry.add(message)
+
+        with self.controll_lock:
+            if self.recorder is not None:
+                self.recorder.record_controlls(self.controlls)
+            now = time.monotonic()
+            if self._last_message is not None and now - self._last_message > self.reconnect_timeout:
+                # The worker may have restarted and lost its config
+                print("Controll Stream: Worker reconnected, sending the full config")
+                self.config_sync.reset()
+                self._worker_acks_config = False
+            self._last_message = now
+            if 'config_ack' in message:
+                self._worker_acks_config = True
+                self.config_sync.acknowledge(message['config_ack'])
+            config = self.config_sync.next_message(self._worker_acks_config)
+            # Copy, the package is serialized after the lock is released
+            package = {
+                "controlls": dict(self.controlls),
+                "config": config,
+                "stamp": time.monotonic()
+            }
+        return package
 
     def send_config(self, config):
-        self.config_queue.put(config)
+        '''Queue config changes for the worker, unchanged keys are not sent'''
+        with self.controll_lock:
+            self.config_sync.update(config)
+
+
+class ControllPublisher:
+    '''
+    Pushes controlls to the worker over a PUB socket as soon as they change,
+    instead of waiting for the worker's next request. If nothing changes the
+    last controlls are repeated at controll_frequency as a heartbeat, so the
+    worker can tell a stopped car from a lost connection. Messages use the
+    binary CONTROLLS format of controll_protocol.py. CONFLATE keeps only the
+    newest message queued, so a slow link never delivers stale controlls.
+    '''
+    def __init__(self, port=cfg.get('controll_push_port'), frequency=cfg.get('controll_frequency'),
+                 context=None):
+        self.host = '0.0.0.0'
+        self.port = port
+        self.period = 1 / frequency
+        self._own_context = context is None
+        self.context = zmq.Context() if context is None else context
+        self.socket = self.context.socket(zmq.PUB)
+        self.socket.setsockopt(zmq.CONFLATE, 1)
+        self.socket.bind(f"tcp://{self.host}:{self.port}")
+        self.controlls = {
+            'throttle': 0.0,
+            'steering': 0.0
+        }
+        self._changed = threading.Condition()
+        self._dirty = False
+        self._running = False
+        self._thread = threading.Thread(target=self._publish_loop, daemon=True)
+
+    def start(self):
+        self._running = True
+        self._thread.start()
+        print(f"Controll Push: Publishing at {self.host}:{self.port}")
+
+    def set_controlls(self, controlls):
+        with self._changed:
+            if controlls != self.controlls:
+                self.controlls.update(controlls)
+                self._dirty = True
+                self._changed.notify()
+
+    def close(self):
+        with self._changed:
+            self._running = False
+            self._changed.notify()
+        self._thread.join()
+        self.socket.close()
+        if self._own_context:
+            self.context.term()
+
+    def _publish_loop(self):
+        while True:
+            with self._changed:
+                # Wakes up on a change or when the heartbeat is due
+                self._changed.wait_for(lambda: self._dirty or not self._running, timeout=self.period)
+                if not self._running:
+                    return
+                controlls = dict(self.controlls)
+                self._dirty = False
+            self.socket.send(encode_reply({'controlls': controlls, 'config': False}, binary=True))
+
+
+class RouterControllStreamServer(ControllStreamServer):
+    '''
+    Controll stream server for several workers on one port. Uses a ROUTER
+    socket and keeps controlls, state, config queue and a throughput counter
+    for every worker, keyed by the worker's socket identity. Workers connect
+    with REQ sockets just like with ControllStreamServer, or with DEALER.
+
+    Workers without their own controlls (see set_controlls) get the shared
+    `controlls`, so the whole fleet can be driven like a single car. `state`
+    holds the last state of any worker.
+    '''
+    SOCKET_TYPE = zmq.ROUTER
+
+    def __init__(self, port=cfg.get('controll_port'), context=None,
+                 frequency=cfg.get('controll_frequency'), reconnect_timeout=2.0):
+        super().__init__(port=port, context=context, frequency=frequency,
+                         reconnect_timeout=reconnect_timeout)
+        self.workers = {} # identity -> per worker state, see _get_worker
+
+    def _get_worker(self, identity):
+        with self.controll_lock:
+            if identity not in self.workers:
+                print(f"Controll Stream: Worker {worker_name(identity)} connected")
+                self.workers[identity] = {
+                    'controlls': None, # None = use the shared controlls
+                    'state': {},
+                    'config_sync': ConfigSync(),
+                    'acks_config': False,
+                    'last_message': None,
+                    'throughput': ThroughputCounter(),
+                    'timing': ControllTiming(self.frequency),
+                    'telemetry': TelemetryStore(),
+                }
+            return self.workers[identity]
+
+    def get_workers(self):
+        with self.controll_lock:
+            return list(self.workers.keys())
+
+    def set_controlls(self, worker, controlls):
+        '''Give a worker its own controlls instead of the shared ones'''
+        with self.controll_lock:
+            if worker in self.workers:
+                w = self.workers[worker]
+                if w['controlls'] is None:
+                    w['controlls'] = dict(self.controlls)
+                w['controlls'].update(controlls)
+
+    def get_state(self, worker):
+        with self.state_lock:
+            if worker in self.workers:
+                return dict(self.workers[worker]['state'])
+            return None
+
+    def get_timing_stats(self, worker=None):
+        '''Timing of the given worker, or of the first worker if None'''
+        with self.controll_lock:
+            if worker is None and self.workers:
+                worker = next(iter(self.workers))
+            # The inherited timing stays empty, it is used until a worker connects
+            timing = self.workers[worker]['timing'] if worker in self.workers else self.timing
+        with self.state_lock:
+            return timing.as_dict()
+
+    def get_worker_stats(self):
+        with self.controll_lock:
+            return {worker_name(identity): {**w['throughput'].as_dict(),
+                                            'timing': w['timing'].as_dict()}
+                    for identity, w in self.workers.items()}
+
+    def send_config(self, config, worker=None):
+        '''Queue a config for one worker, or for all connected workers if None'''
+        with self.controll_lock:
+            if worker is None:
+                targets = self.workers.values()
+            elif worker in self.workers:
+                targets = [self.workers[worker]]
+            else:
+                print(f"Controll Stream: Worker {worker_name(worker)} is not connected, config not sent")
+                targets = []
+            for w in targets:
+                w['config_sync'].update(config)
+
+    def _communication_loop(self):
+        while not self._stop_event.is_set():
+            if self.socket.poll(self.poll_timeout):
+                frames = self.socket.recv_multipart()
+                self.socket.send_multipart(self._on_frames(frames))
+        self.socket.close(linger=0)
+
+    async def communication_loop_async(self):
+        while True:
+            frames = await self.socket.recv_multipart()
+            await self.socket.send_multipart(self._on_frames(frames))
+
+    def feed(self, message, worker=b'replay'):
+        '''Handle a state message as if `worker` had sent it, returns the reply'''
+        return self._on_frames([worker, message])[-1]
+
+    def _on_frames(self, frames):
+        try:
+            return self._handle_frames(frames)
+        except Exception as e:
+            logging.warning(f'Controll Stream: could not handle message: {e!r}')
+            return frames[:-1] + [b'ERROR']
+
+    def _handle_frames(self, frames):
+        # [identity, (empty delimiter from REQ,) message]
+        envelope, message = frames[:-1], frames[-1]
+        identity = envelope[0]
+        w = self._get_worker(identity)
+        w['throughput'].add(len(message))
+
+        state, binary, stamped = decode_state(message)
+        if self.recorder is not None:
+            self.recorder.record_state(state)
+        with self.state_lock:
+            w['timing'].add(state)
+            w['state'] = state
+            self.state = state
+        w['telemetry'].add(state)
 
+        with self.controll_lock:
+            controlls = w['controlls'] if w['controlls'] is not None else self.controlls
+            if self.recorder is not None:
+                self.recorder.record_controlls(controlls)
+            now = time.monotonic()
+            if w['last_message'] is not None and now - w['last_message'] > self.reconnect_timeout:
+                print(f"Controll Stream: Worker {worker_name(identity)} reconnected, sending the full config")
+                w['config_sync'].reset()
+                w['acks_config'] = False
+            w['last_message'] = now
+            if 'config_ack' in state:
+                w['acks_config'] = True
+                w['config_sync'].acknowledge(state['config_ack'])
+            config = w['config_sync'].next_message(w['acks_config'])
+            package = {
+                "controlls": dict(controlls),
+                "config": config,
+                "stamp": time.monotonic()
+            }
+            reply = encode_reply(package, binary, stamped=stamped)
+        return envelope + [reply]
 
 if __name__ == '__main__':
-    import time
     controll_server = ControllStreamServer()
     controll_server.start()
     n = 0
@@ -77,4 +426,4 @@ if __name__ == '__main__':
             controll_server.controlls['throttle'] = n
             controll_server.controlls['steering'] = 0.5
             n += 1
-        time.sleep(0.05)
\ No newline at end of file
+        time.sleep(0.05)
\ No newline at end of file
@@ -0,0 +1,58 @@
+'''
+Wire format of the image stream.
+
+Version 0 (legacy):  [size: uint32][jpeg bytes]
+Version 1:           [magic 'SCF'][version: uint8][sequence: uint32]
+                     [capture time: float64][encode time: float32]
+                     [width: uint16][height: uint16][size: uint32][jpeg bytes]
+
+All fields are big endian. The capture time is a unix timestamp taken on
+the car, so latencies are only meaningful if both clocks are synchronised
+(e.g. with NTP). A legacy header starts with the high byte of the size,
+which is 0 for any realistic JPEG, so it can never be mistaken for the magic.
+'''
+
+import struct
+import time
+from collections import namedtuple
+
+MAGIC = b'SCF'
+VERSION = 1
+_LEGACY_HEADER = struct.Struct('>I')
+_HEADER_V1 = struct.Struct('>3sBIdfHHI')
+
+FrameHeader = namedtuple('FrameHeader', [
+    'version',      # 0 for legacy frames
+    'sequence',     # frame counter of the worker, None for legacy frames
+    'capture_time', # unix time the frame was captured, None for legacy frames
+    'encode_time',  # seconds it took to encode the JPEG, None for legacy frames
+    'width',        # resolution of the frame, None for legacy frames
+    'height',
+    'receive_time', # unix time the frame was received by the controller
+])
+
+
+def pack_frame(img_bytes, sequence, capture_time, encode_time, width, height) -> bytes:
+    '''Build a version 1 message. Used by the worker and for replaying recordings.'''
+    header = _HEADER_V1.pack(MAGIC, VERSION, sequence & 0xFFFFFFFF, capture_time,
+                             encode_time, width, height, len(img_bytes))
+    return header + img_bytes
+
+
+def unpack_frame(message, receive_time=None):
+    '''Split a message into its FrameHeader and the JPEG bytes'''
+    if receive_time is None:
+        receive_time = time.time()
+    if message[:3] == MAGIC:
+        _, version, sequence, capture_time, encode_time, width, height, size = \
+            _HEADER_V1.unpack_from(message)
+        if version != VERSION:
+            raise ValueError(f'Unsupported frame header version {version}')
+        start = _HEADER_V1.size
+        header = FrameHeader(version, sequence, capture_time, encode_time,
+                             width, height, receive_time)
+    else:
+        size, = _LEGACY_HEADER.unpack_from(message)
+        start = _LEGACY_HEADER.size
+        header = FrameHeader(0, None, None, None, None, None, receive_time)
+    return header, message[start:start+size]
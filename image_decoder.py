@@ -0,0 +1,140 @@
+import io
+import threading
+import numpy as np
+from PIL import Image
+
+# Optional faster backends
+try:
+    import simplejpeg
+except ImportError:
+    simplejpeg = None
+try:
+    import cv2
+except ImportError:
+    cv2 = None
+
+
+class BufferPool:
+    '''
+    A small ring of preallocated output arrays for a given image shape.
+    Buffers are handed out round robin, so a buffer is only overwritten after
+    `size` further frames have been decoded. The pool has to be larger than
+    the number of frames a consumer keeps around at the same time.
+    '''
+    def __init__(self, size):
+        self.size = size
+        self._shape = None
+        self._buffers = []
+        self._index = 0
+        self._lock = threading.Lock()
+
+    def get(self, shape):
+        with self._lock:
+            if shape != self._shape:
+                self._shape = shape
+                self._buffers = [np.empty(shape, np.uint8) for _ in range(self.size)]
+                self._index = 0
+            buffer = self._buffers[self._index]
+            self._index = (self._index + 1) % self.size
+            return buffer
+
+
+class ImageDecoder:
+    '''
+    Base class of the JPEG decoders. decode() returns an RGB uint8 array.
+    scale is the downscaling denominator (1, 2, 4 or 8); the backends scale in
+    the DCT domain, which is much cheaper than decoding at full resolution
+    and resizing afterwards.
+    '''
+    SCALES = (1, 2, 4, 8)
+
+    def __init__(self, scale=1, buffers=4):
+        if scale not in self.SCALES:
+            raise ValueError(f'Unsupported decode scale 1/{scale}')
+        self.scale = scale
+        self._pool = BufferPool(buffers)
+
+    def decode(self, img_bytes) -> np.ndarray:
+        raise NotImplementedError
+
+
+class PILDecoder(ImageDecoder):
+    name = 'pil'
+
+    def decode(self, img_bytes):
+        img = Image.open(io.BytesIO(img_bytes))
+        if self.scale != 1:
+            # draft() makes libjpeg decode at a reduced size
+            img.draft('RGB', (img.width // self.scale, img.height // self.scale))
+        img = img.convert('RGB')
+        buffer = self._pool.get((img.height, img.width, 3))
+        buffer[...] = np.asarray(img)
+        return buffer
+
+
+class OpenCVDecoder(ImageDecoder):
+    name = 'cv2'
+
+    _READ_FLAGS = {
+        1: 'IMREAD_COLOR',
+        2: 'IMREAD_REDUCED_COLOR_2',
+        4: 'IMREAD_REDUCED_COLOR_4',
+        8: 'IMREAD_REDUCED_COLOR_8',
+    }
+
+    def __init__(self, scale=1, buffers=4):
+        if cv2 is None:
+            raise ImportError('OpenCV is not installed')
+        super().__init__(scale, buffers)
+        self._flag = getattr(cv2, self._READ_FLAGS[scale])
+
+    def decode(self, img_bytes):
+        img = cv2.imdecode(np.frombuffer(img_bytes, np.uint8), self._flag)
+        if img is None:
+            raise ValueError('Could not decode image')
+        buffer = self._pool.get(img.shape)
+        # OpenCV decodes to BGR, convert directly into the output buffer
+        cv2.cvtColor(img, cv2.COLOR_BGR2RGB, dst=buffer)
+        return buffer
+
+
+class SimpleJPEGDecoder(ImageDecoder):
+    '''libjpeg-turbo through simplejpeg, decodes straight into the output buffer'''
+    name = 'simplejpeg'
+
+    def __init__(self, scale=1, buffers=4):
+        if simplejpeg is None:
+            raise ImportError('simplejpeg is not installed')
+        super().__init__(scale, buffers)
+
+    def decode(self, img_bytes):
+        height, width, _, _ = simplejpeg.decode_jpeg_header(img_bytes)
+        # libjpeg rounds scaled dimensions up
+        shape = (-(-height // self.scale), -(-width // self.scale), 3)
+        buffer = self._pool.get(shape)
+        return simplejpeg.decode_jpeg(img_bytes, colorspace='RGB',
+                                      min_height=shape[0],
+                                      min_width=shape[1],
+                                      min_factor=self.scale,
+                                      buffer=buffer)
+
+
+DECODERS = {
+    'simplejpeg': SimpleJPEGDecoder,
+    'cv2': OpenCVDecoder,
+    'pil': PILDecoder,
+}
+
+
+def create_decoder(name='auto', scale=1, buffers=4) -> ImageDecoder:
+    '''Create a decoder by name. 'auto' picks the fastest installed backend.'''
+    if name == 'auto':
+        if simplejpeg is not None:
+            name = 'simplejpeg'
+        elif cv2 is not None:
+            name = 'cv2'
+        else:
+            name = 'pil'
+    if name not in DECODERS:
+        raise ValueError(f'Unknown image decoder {name}')
+    return DECODERS[name](scale=scale, buffers=buffers)
@@ -7,14 +7,20 @@ from pyfiglet import Figlet
 os.environ['PYGAME_HIDE_SUPPORT_PROMPT'] = "hide"
 import pygame as pg
 
-from camera_stream_server import CameraStreamServer
+from camera_stream_server import CameraStreamServer, RouterCameraStreamServer
+from shared_frame_ring import MultiprocessCameraStreamServer
 #from camera_stream_receiver import CameraStreamReceiver # Experimental Stream using ffmpeg
-from controll_stream_server import ControllStreamServer
+from controll_stream_server import ControllStreamServer, RouterControllStreamServer, ControllPublisher
 from stella_vslam_connector import StellaConnector
+from session_recorder import SessionRecorder
+from adaptive_stream import AdaptiveStreamController
+from async_core import AsyncControllerCore
 
 from base_model import CarModel
+from pose_predictor import PosePredictor
 from ui_elements import UIButton, UIText, ConfigWindow, UIContainer
 from config import Config as cfg
+from stream_stats import worker_name
 import webbrowser
 
 class SlamcarController:
@@ -38,10 +44,50 @@ class SlamcarController:
         self.time_last_pressed = 0  # time last key was pressed
 
         self.connected = False # Worker connected
+        self.multi_worker = cfg.get('multi_worker') # serve several workers on the same ports
+        self._preview_worker = None # identity of the worker shown in the preview, see _reviece_images
 
         # Data stream servers
-        self.image_server = CameraStreamServer(port=cfg.get('image_stream_port'))
-        self.controll_server = ControllStreamServer(port=cfg.get('controll_port'))
+        self.core = None
+        if cfg.get('async_core'):
+            # Both servers and the Stella status polling run on one event loop
+            self.core = AsyncControllerCore()
+            self.image_server = self.core.image_server
+            self.controll_server = self.core.controll_server
+        elif self.multi_worker:
+            self.image_server = RouterCameraStreamServer(port=cfg.get('image_stream_port'))
+            self.controll_server = RouterControllStreamServer(port=cfg.get('controll_port'))
+        else:
+            if cfg.get('multiprocess_ingest'):
+                # Receive and decode images in a separate process
+                self.image_server = MultiprocessCameraStreamServer()
+            else:
+                self.image_server = CameraStreamServer(port=cfg.get('image_stream_port'))
+            self.controll_server = ControllStreamServer(port=cfg.get('controll_port'))
+
+        # Push controlls to the worker as soon as they change
+        self.controll_publisher = None
+        if cfg.get('controll_push'):
+            self.controll_publisher = ControllPublisher(port=cfg.get('controll_push_port'))
+
+        # Adapt image quality, size and rate of the worker to the stream health
+        self.stream_adaptation = None
+        self._time_last_adaptation = 0
+        if cfg.get('adaptive_stream') and isinstance(self.image_server, CameraStreamServer):
+            # The frames are fed to SLAM, which needs the size it was calibrated for
+            self.stream_adaptation = AdaptiveStreamController(self.image_server, keep_resolution=True)
+
+        # Record the image and controll streams for replay
+        self.recorder = None
+        if cfg.get('record_sessions'):
+            session_name = time.strftime('session_%Y%m%d_%H%M%S')
+            self.recorder = SessionRecorder(os.path.join(current_path, 'recordings', session_name + '.slrec'))
+            if isinstance(self.image_server, MultiprocessCameraStreamServer):
+                # The ingest process records the frames into its own session
+                self.image_server.recording_path = os.path.join(current_path, 'recordings', session_name + '_frames.slrec')
+            else:
+                self.image_server.recorder = self.recorder
+            self.controll_server.recorder = self.recorder
 
         # Stella VSLAM connector
         self.stella_connector = None # gets initialized when worker connects
@@ -65,32 +111,45 @@ class SlamcarController:
         # camera image
         self._show_camera_preview = False
         self._image_preview_last_image = np.zeros((480, 640, 3), np.uint8)
+        self._image_preview_scaled = None # preview decoded at preview_decode_scale, see _reviece_images
 
         # Stella UI
         self.stella_connector = StellaConnector()
         self.stella_connector.start_stella_containers()
+        if self.core is not None:
+            self.core.stella_connector = self.stella_connector
         self.stella_status_text = UIText((10, 600), 'Stella VSLAM starting ...')
         self.stella_virtual_device_initialized = False
 
         # Connected Worker Window
-        self._connected_worker_window = None
+        self._worker_windows = {} # worker name -> UIContainer
 
     def run(self):
         initial_position = (3, 3)
         self.car = CarModel(*initial_position)
-        self.image_server.start()
-        self.controll_server.start()
+        # Pose of the real car now and when the last frame was captured
+        self.pose_predictor = PosePredictor(self.car)
+        self.predicted_pose = self.pose_predictor.predict_now()
+        self.frame_pose = None
+        self._time_last_delay_update = 0
+        if self.core is not None:
+            self.core.start()
+        else:
+            self.image_server.start()
+            self.controll_server.start()
+        if self.controll_publisher is not None:
+            self.controll_publisher.start()
 
         while not self.exit:            
-            dt = self.clock.get_time() / 100
-            self.screen.fill((30, 30, 30))
+            frame_time = self.clock.get_time() / 1000
 
             # Draw connected worker window
             self._draw_connected_worker_window()
 
             # Update
-            self.car.update(dt)
+            self.car.advance(frame_time)
             self._update_controlls()
+            self._update_pose_prediction()
             # Handle events
             for event in pg.event.get():
                 if event.type == pg.QUIT:
@@ -100,7 +159,13 @@ class SlamcarController:
                     if event.action == 'config_changed':
                         self.car.load_parameters()
                     if event.action == 'remote_config_changed':
-                        self.controll_server.send_config(cfg.get('car_parameters'))
+                        # Only keys the worker doesn't have yet are sent, a
+                        # restarted worker gets everything again, see ConfigSync.reset
+                        worker = getattr(event, 'worker', None)
+                        if worker is None:
+                            self.controll_server.send_config(cfg.get('car_parameters'))
+                        else:
+                            self.controll_server.send_config(cfg.get('car_parameters'), worker=worker)
                 if event.type == pg.MOUSEBUTTONDOWN:
                     # Zoom in and out with mouse wheel
                     if event.button == 4:
@@ -115,7 +180,7 @@ class SlamcarController:
                 self._config_window.update(event)
             
             # Draw
-            self.car.draw(self.screen, self.ppu)  # draw car
+            self.car.draw(self.screen, self.ppu)  # draw grid and car, clears the screen
             self._draw_gui(self.screen)           # draw gui
             for element in self.ui_elements:
                 element.draw(self.screen)
@@ -126,6 +191,7 @@ class SlamcarController:
 
             # Show image preview
             self._reviece_images()
+            self._update_stream_adaptation()
 
             self.clock.tick(self.ticks)
             pg.display.flip()
@@ -136,7 +202,16 @@ class SlamcarController:
                 
         cv2.destroyAllWindows()
         
-        self.image_server.close()
+        if self.core is not None:
+            self.core.stop()
+        else:
+            self.image_server.close()
+            self.controll_server.close()
+        if self.controll_publisher is not None:
+            self.controll_publisher.close()
+        if self.recorder is not None:
+            self.recorder.close()
+        cfg.flush() # write pending config changes
         pg.quit()
 
 
@@ -160,9 +235,17 @@ class SlamcarController:
                                     f"{local_ip}", font_size=14))
 
     
-    def _toggle_camera_preview(self):
+    def _toggle_camera_preview(self, worker=None):
+        if self._show_camera_preview and worker != self._preview_worker:
+            # Switch the preview to another worker
+            self._preview_worker = worker
+            return
+        self._preview_worker = worker
         self._show_camera_preview = not self._show_camera_preview
 
+    def _reinit_worker(self, worker=None):
+        pg.event.post(pg.event.Event(pg.USEREVENT, {"action": "remote_config_changed", "worker": worker}))
+
     def _toggle_configuration_window(self):
         self._show_config = not self._show_config
 
@@ -203,19 +286,39 @@ class SlamcarController:
                                "."*(self._gui_connection_text_helper+1), True, (255, 255, 255))
             screen.blit(text, position)
 
-        if self.stella_connector.check_stella_containers():
+        if self.core is not None:
+            stella_running = self.core.stella_running # polled in the background
+        else:
+            stella_running = self.stella_connector.check_stella_containers()
+        if stella_running:
             self.stella_status_text.update_text('Stella VSLAM running')
             self.stella_status_text.update_text_color((0, 255, 0))
     
-    def _draw_connected_worker_window(self):    
-        if self._connected_worker_window is None and self.connected:   
-            self._connected_worker_window = UIContainer((20, 50), (150, 200))
-            self._connected_worker_window.add_element(UIText((40,20), "Worker 1", font_size=20))
-            self._connected_worker_window.add_element(UIButton((10,50), (130, 30), "Toggle Preview", self._toggle_camera_preview))
-            self._connected_worker_window.add_element(UIButton((10,80), (130, 30), "Reinitialize", self._config_window.reinit_worker))
-            self._connected_worker_window.add_element(UIButton((10,110), (130, 30), "Open Viewer", self.stella_connector.open_stella_viewer))
-            self._connected_worker_window.add_element(UIButton((10,140), (130, 30), "Start VSLAM", self.stella_connector.start_camera_vslam))
-            self.ui_elements.append(self._connected_worker_window)
+    def _draw_connected_worker_window(self):
+        # One window for every connected worker, next to each other
+        for name, image_worker, controll_worker in self._connected_workers():
+            if name in self._worker_windows:
+                continue
+            window = UIContainer((20 + 160 * len(self._worker_windows), 50), (150, 200))
+            window.add_element(UIText((40,20), name, font_size=20))
+            window.add_element(UIButton((10,50), (130, 30), "Toggle Preview", self._toggle_camera_preview, image_worker))
+            window.add_element(UIButton((10,80), (130, 30), "Reinitialize", self._reinit_worker, controll_worker))
+            window.add_element(UIButton((10,110), (130, 30), "Open Viewer", self.stella_connector.open_stella_viewer))
+            window.add_element(UIButton((10,140), (130, 30), "Start VSLAM", self.stella_connector.start_camera_vslam))
+            self._worker_windows[name] = window
+            self.ui_elements.append(window)
+
+    def _connected_workers(self):
+        '''List of (name, image stream identity, controll stream identity)'''
+        if not self.multi_worker:
+            return [("Worker 1", None, None)] if self.connected else []
+        # Workers that use the same identity on both sockets share a window
+        workers = {}
+        for identity in self.image_server.get_workers():
+            workers[worker_name(identity)] = [identity, None]
+        for identity in self.controll_server.get_workers():
+            workers.setdefault(worker_name(identity), [None, None])[1] = identity
+        return [(name, image_worker, controll_worker) for name, (image_worker, controll_worker) in workers.items()]
 
 
     def _draw_configuration(self):
@@ -238,9 +341,15 @@ class SlamcarController:
         if not hasattr(self, 'i_counter'):
             self.i_counter = 0
 
-        image = self.image_server.receive_image()
-        if image is not None:
+        if self.multi_worker:
+            # The other workers' queues just drop their oldest frames
+            frame = self.image_server.receive_frame(self._preview_worker)
+        else:
+            frame = self.image_server.receive_frame()
+        if frame is not None:
+            image, header = frame
             self.connected = True
+            self.frame_pose = self.pose_predictor.predict_for_frame(header)
             self._image_preview_last_image = image
       
             self.i_counter += 1
@@ -249,7 +358,18 @@ class SlamcarController:
                 
         # show image in a separate window if connected and preview is enabled
         if self.connected and self._show_camera_preview:
-            cv2.imshow(window_name, self._image_preview_last_image)
+            # The preview can be decoded at a lower resolution than the frames for SLAM
+            if getattr(self.image_server, 'preview_scale', 1) != 1:
+                if self.multi_worker:
+                    preview = self.image_server.receive_preview(self._preview_worker)
+                else:
+                    preview = self.image_server.receive_preview()
+                if preview is not None:
+                    self._image_preview_scaled = preview
+            if self._image_preview_scaled is not None:
+                cv2.imshow(window_name, self._image_preview_scaled)
+            else:
+                cv2.imshow(window_name, self._image_preview_last_image)
             cv2.waitKey(1)
         else:
             # otherwise destroy the window
@@ -258,6 +378,26 @@ class SlamcarController:
             except:
                 pass
 
+    def _update_stream_adaptation(self):
+        if self.stream_adaptation is None or not self.connected:
+            return
+        if time.time() - self._time_last_adaptation < 1:
+            return
+        self._time_last_adaptation = time.time()
+        recommendation = self.stream_adaptation.update()
+        if recommendation is not None:
+            self.controll_server.send_config(recommendation)
+
+    def _update_pose_prediction(self):
+        # Commands reach the car after half a round trip plus on average
+        # half a controll period until the worker asks for them
+        if time.time() - self._time_last_delay_update > 1:
+            self._time_last_delay_update = time.time()
+            rtt = self.controll_server.get_timing_stats()['rtt']['mean']
+            if rtt is not None:
+                self.pose_predictor.command_delay = rtt / 2 + 0.5 / cfg.get('controll_frequency')
+        self.predicted_pose = self.pose_predictor.predict_now()
+
     def _get_local_ip(self):
         s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         try:
@@ -305,6 +445,11 @@ class SlamcarController:
             self.controll_server.controlls['steering'] = self.controlls['steering']
             self.controll_server.controlls['throttle'] = self.controlls['throttle']
 
+        if self.controll_publisher is not None:
+            self.controll_publisher.set_controlls(self.controlls)
+
+        self.pose_predictor.add_command(self.controlls['steering'], self.controlls['throttle'])
+
         return
     
 
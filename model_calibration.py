@@ -0,0 +1,208 @@
+'''
+Calibration of the CarModel parameters against a recorded drive.
+
+Takes the controll commands of a recorded session (see session_recorder.py)
+and reference poses of the real car, e.g. the keyframe trajectory exported
+by stella_vslam in TUM format, and fits max_velocity, max_steering and
+magic_number with Levenberg-Marquardt least squares.
+
+The drive is cut into short overlapping windows. Each window starts at the
+reference pose and is simulated forward with the recorded commands, so the
+error does not accumulate over the whole drive. All windows and all
+parameter sets needed for one iteration (the finite difference Jacobian
+and several damping values) are simulated as one BatchCarModel.
+
+The reference poses have to be metric and on the controller's clock
+(time.time()), use --time-offset to shift them.
+
+Usage:
+    python model_calibration.py recordings/<session>.slrec <trajectory.txt> [--write]
+'''
+
+import argparse
+import json
+import numpy as np
+
+from config import Config as cfg
+from batch_simulator import BatchCarModel
+from session_recorder import SessionReplay, RECORD_CONTROLLS
+
+FIT_PARAMETERS = ('max_velocity', 'max_steering', 'magic_number')
+MODEL_PARAMETERS = ('max_steering', 'steering_speed', 'max_velocity', 'acceleration', 'car_length', 'magic_number')
+
+
+def load_commands(session_path):
+    '''Return (times, steering, throttle) of the controlls sent in a recorded session'''
+    replay = SessionReplay(session_path)
+    times, steering, throttle = [], [], []
+    for t, _, payload in replay.records(RECORD_CONTROLLS):
+        controlls = json.loads(payload)
+        times.append(t)
+        steering.append(controlls['steering'])
+        throttle.append(controlls['throttle'])
+    return np.array(times), np.array(steering), np.array(throttle)
+
+
+def load_tum_trajectory(path, plane=(0, 2), time_offset=0.0):
+    '''
+    Load a trajectory in TUM format (timestamp tx ty tz qx qy qz qw) and
+    project it onto the ground plane spanned by the two `plane` axes.
+    Returns (times, x, y, heading) with the heading in degrees, taken from
+    the camera's viewing direction (its z axis).
+    '''
+    data = np.loadtxt(path, comments='#', ndmin=2)
+    times = data[:, 0] + time_offset
+    position = data[:, 1:4]
+    qx, qy, qz, qw = data[:, 4], data[:, 5], data[:, 6], data[:, 7]
+    # Third column of the rotation matrix
+    forward = np.stack([
+        2 * (qx * qz + qw * qy),
+        2 * (qy * qz - qw * qx),
+        1 - 2 * (qx * qx + qy * qy),
+    ], axis=1)
+    a, b = plane
+    heading = np.degrees(np.arctan2(forward[:, b], forward[:, a]))
+    return times, position[:, a], position[:, b], heading
+
+
+class ModelCalibration:
+    def __init__(self, commands, poses,
+                 parameters=FIT_PARAMETERS,
+                 dt=None,
+                 horizon=2.0,
+                 stride=0.5,
+                 heading_weight=0.1,
+                 time_scale=10):
+        '''
+        commands: (times, steering, throttle), poses: (times, x, y, heading)
+        dt: simulation step in seconds, defaults to the physics rate
+        horizon: length of a window in seconds, stride: seconds between windows
+        heading_weight: meters of position error one radian of heading error is worth
+        time_scale: model time units per second, see CarModel.time_scale
+        '''
+        self.parameters = tuple(parameters)
+        self.dt = dt if dt is not None else 1 / cfg.get('physics_rate')
+        self.time_scale = time_scale
+        self.heading_weight = heading_weight
+        self.values = {key: float(cfg.get(key)) for key in MODEL_PARAMETERS}
+        self.rms = None # root mean square residual after fit()
+
+        command_times, steering, throttle = (np.asarray(a, np.float64) for a in commands)
+        pose_times, x, y, heading = (np.asarray(a, np.float64) for a in poses)
+        start = max(command_times[0], pose_times[0])
+        end = min(command_times[-1], pose_times[-1])
+        grid = np.arange(start, end, self.dt)
+        steps = int(round(horizon / self.dt))
+        if len(grid) <= steps:
+            raise ValueError('Commands and poses overlap for less than one window')
+
+        # Commands are held until the next one, poses are interpolated
+        held = np.clip(np.searchsorted(command_times, grid, 'right') - 1, 0, len(command_times) - 1)
+        grid_steering = steering[held]
+        grid_throttle = throttle[held]
+        grid_x = np.interp(grid, pose_times, x)
+        grid_y = np.interp(grid, pose_times, y)
+        grid_heading = np.degrees(np.interp(grid, pose_times, np.unwrap(np.radians(heading))))
+
+        # Windows of steps + 1 grid points as (steps + 1, windows) arrays
+        starts = np.arange(0, len(grid) - steps, max(1, int(round(stride / self.dt))))
+        index = starts[None, :] + np.arange(steps + 1)[:, None]
+        self.steering = grid_steering[index]
+        self.throttle = grid_throttle[index]
+        self.x = grid_x[index]
+        self.y = grid_y[index]
+        self.heading = grid_heading[index]
+        self.windows = len(starts)
+
+    def residuals(self, batch):
+        '''
+        Residuals for a batch of parameter sets of shape (sets, len(parameters)),
+        returns an array of shape (sets, residuals).
+        '''
+        batch = np.atleast_2d(batch)
+        sets = len(batch)
+        n = sets * self.windows
+        values = dict(self.values)
+        for i, key in enumerate(self.parameters):
+            values[key] = np.repeat(batch[:, i], self.windows)
+        model = BatchCarModel(n, **values)
+
+        def tiled(a):
+            return np.tile(a, (1, sets)) if a.ndim == 2 else np.tile(a, sets)
+
+        model.reset(x=tiled(self.x[0]), y=tiled(self.y[0]), heading=tiled(self.heading[0]),
+                    velocity=tiled(self.throttle[0]) * model.max_velocity,
+                    steering=tiled(self.steering[0]) * model.max_steering)
+        steps = len(self.x) - 1
+        x, y, heading = np.empty((steps, n)), np.empty((steps, n)), np.empty((steps, n))
+        steering, throttle = tiled(self.steering), tiled(self.throttle)
+        dt = self.dt * self.time_scale
+        for k in range(steps):
+            model.step_commands(steering[k + 1], throttle[k + 1], dt)
+            x[k], y[k], heading[k] = model.x, model.y, model.heading
+
+        heading_error = (heading - tiled(self.heading[1:]) + 180) % 360 - 180
+        errors = [x - tiled(self.x[1:]),
+                  y - tiled(self.y[1:]),
+                  np.radians(heading_error) * self.heading_weight]
+        # (steps, sets * windows) -> (sets, steps * windows)
+        return np.concatenate([e.reshape(steps, sets, self.windows).transpose(1, 0, 2).reshape(sets, -1)
+                               for e in errors], axis=1)
+
+    def fit(self, iterations=20, damping=1e-3, tolerance=1e-6):
+        '''Fit the parameters with Levenberg-Marquardt, returns a dict of the fitted values'''
+        p = np.array([self.values[key] for key in self.parameters])
+        r = self.residuals(p)[0]
+        cost = r @ r
+        factors = np.array([0.1, 1.0, 10.0, 100.0])
+        for _ in range(iterations):
+            # Forward differences, all parameter sets in one batch
+            h = 1e-4 * np.maximum(np.abs(p), 1e-3)
+            perturbed = self.residuals(p + np.diag(h))
+            jacobian = ((perturbed - r) / h[:, None]).T
+            jtj = jacobian.T @ jacobian
+            gradient = jacobian.T @ r
+
+            # Try several damping values at once and keep the best
+            candidates = np.array([p + np.linalg.lstsq(jtj + d * np.diag(np.diag(jtj)), -gradient, rcond=None)[0]
+                                   for d in damping * factors])
+            candidate_residuals = self.residuals(candidates)
+            costs = np.einsum('ij,ij->i', candidate_residuals, candidate_residuals)
+            best = int(np.argmin(costs))
+            if costs[best] >= cost:
+                damping *= 100
+                continue
+            improvement = (cost - costs[best]) / cost
+            p, r, cost = candidates[best], candidate_residuals[best], costs[best]
+            damping *= factors[best]
+            if improvement < tolerance:
+                break
+
+        self.values.update(zip(self.parameters, p.tolist()))
+        self.rms = float(np.sqrt(cost / len(r)))
+        return {key: self.values[key] for key in self.parameters}
+
+    def write_config(self):
+        '''Write the fitted parameters to the base_model config group'''
+        with cfg.transaction():
+            for key in self.parameters:
+                cfg.set(key, round(self.values[key], 6))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Fit the car model to a recorded drive')
+    parser.add_argument('session', help='recorded session (.slrec)')
+    parser.add_argument('trajectory', help='reference poses in TUM format')
+    parser.add_argument('--time-offset', type=float, default=0.0, help='seconds added to the pose timestamps')
+    parser.add_argument('--write', action='store_true', help='write the result to config.json')
+    args = parser.parse_args()
+
+    calibration = ModelCalibration(load_commands(args.session),
+                                   load_tum_trajectory(args.trajectory, time_offset=args.time_offset))
+    result = calibration.fit()
+    for key, value in result.items():
+        print(f'{key}: {value:.6f}')
+    print(f'rms residual: {calibration.rms:.4f}')
+    if args.write:
+        calibration.write_config()
+        cfg.flush()
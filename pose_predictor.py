@@ -0,0 +1,159 @@
+import math
+import time
+import threading
+from collections import deque
+import numpy as np
+from pygame.math import Vector2
+
+
+class PosePredictor:
+    '''
+    Predicts where the real car is at a given time from the last confirmed
+    pose and the controll commands sent since.
+
+    Commands reach the car `command_delay` seconds after they were sent, so
+    the car lags behind the simulated CarModel. The predictor replays the
+    recent commands with the CarModel kinematics (the same exact arc as
+    BatchCarModel._update_position) from the last confirmed pose up to the
+    requested time. Between two commands steering and velocity are
+    constant, so every command needs only one integration step. There is
+    only one car, so the steps are plain scalar math.
+
+    Confirmed poses come from confirm(), e.g. with a SLAM pose. Commands
+    older than `history` seconds are folded into the confirmed pose one by
+    one as they expire, so without confirmations the predictor
+    dead-reckons from the start pose. predict_now() keeps a checkpoint at
+    the last command it applied and only replays the commands after it.
+    Times are unix times like FrameHeader.capture_time, headings are in
+    degrees with 0 pointing along +x.
+    '''
+    def __init__(self, car, history=2.0, command_delay=0.0, time_scale=10):
+        self.car = car                     # CarModel that provides the parameters and the start pose
+        self.history = history             # seconds of commands to keep
+        self.command_delay = command_delay # seconds until a sent command is applied by the car
+        self.time_scale = time_scale       # model time units per second, see CarModel.time_scale
+        self._commands = deque()           # (time, steering, throttle)
+        self._lock = threading.Lock()
+
+        heading = -car.heading.angle_to(Vector2(1, 0))
+        steering = car.steering / car.max_steering if car.max_steering else 0.0
+        throttle = car.velocity_magnitude / car.max_velocity if car.max_velocity else 0.0
+        # (time, x, y, heading, steering, throttle) of the last confirmed state
+        self._confirmed = (time.time(), car.position.x, car.position.y, heading, steering, throttle)
+        # State at the last command applied by predict_now(), with the command delay it used
+        self._checkpoint = None
+
+    def add_command(self, steering, throttle, t=None):
+        '''Record a command sent to the worker, unchanged commands are skipped'''
+        if t is None:
+            t = time.time()
+        with self._lock:
+            last = self._commands[-1][1:] if self._commands else self._confirmed[4:]
+            if (steering, throttle) == last:
+                return
+            self._commands.append((t, steering, throttle))
+            self._fold_history(t - self.history)
+
+    def confirm(self, x, y, heading, t=None):
+        '''Set the pose the car was observed at, e.g. from SLAM'''
+        if t is None:
+            t = time.time()
+        with self._lock:
+            # Commands that were applied by time t are part of the confirmed state
+            steering, throttle = self._confirmed[4:]
+            while self._commands and self._commands[0][0] + self.command_delay <= t:
+                _, steering, throttle = self._commands.popleft()
+            self._confirmed = (t, x, y, heading, steering, throttle)
+            self._checkpoint = None
+
+    def predict(self, times):
+        '''Predict the poses at the given times, returns arrays (x, y, heading)'''
+        times = np.atleast_1d(np.asarray(times, np.float64))
+        poses = np.array([self.predict_at(float(t)) for t in times], np.float64).reshape(-1, 3)
+        return poses[:, 0], poses[:, 1], poses[:, 2]
+
+    def predict_at(self, t):
+        '''Pose of the car at time t as (x, y, heading)'''
+        with self._lock:
+            x, y, heading, _ = self._replay(t)
+        return x, y, heading
+
+    def predict_now(self):
+        '''Pose of the car now as (x, y, heading)'''
+        with self._lock:
+            x, y, heading, checkpoint = self._replay(time.time())
+            self._checkpoint = checkpoint
+        return x, y, heading
+
+    def predict_for_frame(self, header):
+        '''
+        Pose of the car when the frame was captured as (x, y, heading). Legacy
+        frames have no capture time, their receive time is used instead.
+        '''
+        t = header.capture_time if header.capture_time is not None else header.receive_time
+        return self.predict_at(t)
+
+    def _replay(self, t):
+        # Start from the checkpoint if it is still on the current trajectory
+        # and not after t, otherwise from the confirmed state
+        state = self._confirmed
+        checkpoint = self._checkpoint
+        if checkpoint is not None and checkpoint[1] == self.command_delay \
+                and state[0] <= checkpoint[0][0] <= t:
+            state = checkpoint[0]
+        start, x, y, heading, steering, throttle = state
+
+        # Commands applied after the start, newest last
+        newer = []
+        for command in reversed(self._commands):
+            if command[0] + self.command_delay <= start:
+                break
+            newer.append(command)
+
+        for command_time, command_steering, command_throttle in reversed(newer):
+            applied = command_time + self.command_delay
+            if applied > t:
+                break
+            x, y, heading = self._step(x, y, heading, steering, throttle, applied - start)
+            start, steering, throttle = applied, command_steering, command_throttle
+        checkpoint = ((start, x, y, heading, steering, throttle), self.command_delay)
+
+        x, y, heading = self._step(x, y, heading, steering, throttle, t - start)
+        return x, y, heading, checkpoint
+
+    def _step(self, x, y, heading, steering, throttle, seconds):
+        # Drive `seconds` with constant commands, see BatchCarModel._update_position
+        if seconds <= 0:
+            return x, y, heading
+        car = self.car
+        dt = seconds * self.time_scale
+        steering = steering * car.max_steering
+        velocity = throttle * car.max_velocity
+        heading_x, heading_y = math.cos(math.radians(heading)), math.sin(math.radians(heading))
+        if abs(steering) < 0.01:
+            distance = velocity * dt * car.magic_number
+            return x + heading_x * distance, y + heading_y * distance, heading
+
+        # Point around which the car is rotating, see CarModel._calculate_steering_rotation_point
+        radius = car.length / math.tan(math.radians(steering))
+        center_x = x - radius * heading_y + car.rotation_position * heading_x * car.length / 2
+        center_y = y + radius * heading_x + car.rotation_position * heading_y * car.length / 2
+        rotation = velocity / radius * dt # degrees
+        cos, sin = math.cos(math.radians(rotation)), math.sin(math.radians(rotation))
+        relative_x, relative_y = x - center_x, y - center_y
+        return (center_x + cos * relative_x - sin * relative_y,
+                center_y + sin * relative_x + cos * relative_y,
+                heading + rotation)
+
+    def _fold_history(self, cutoff):
+        # Move the confirmed state over the commands that were applied before
+        # the cutoff, so predictions only replay the last `history` seconds
+        start, x, y, heading, steering, throttle = self._confirmed
+        while self._commands and self._commands[0][0] + self.command_delay <= cutoff:
+            command_time, command_steering, command_throttle = self._commands.popleft()
+            applied = command_time + self.command_delay
+            if applied > start:
+                x, y, heading = self._step(x, y, heading, steering, throttle, applied - start)
+                start = applied
+            steering, throttle = command_steering, command_throttle
+        self._confirmed = (start, x, y, heading, steering, throttle)
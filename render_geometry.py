@@ -0,0 +1,56 @@
+import math
+import numpy as np
+
+
+def _rectangle(length, width):
+    '''Corners of a rectangle centered on the origin with its length along x'''
+    return np.array([
+        (-length / 2, width / 2),
+        (length / 2, width / 2),
+        (length / 2, -width / 2),
+        (-length / 2, -width / 2),
+    ])
+
+
+def _rotation(degrees):
+    '''Rotation matrix with the same direction as Vector2.rotate()'''
+    c, s = math.cos(math.radians(degrees)), math.sin(math.radians(degrees))
+    return np.array(((c, -s), (s, c)))
+
+
+class CarGeometry:
+    '''
+    Template polygons of the car body and the tires in car coordinates
+    (meters, x towards the front), built once for the car dimensions.
+
+    transform() turns the car pose and the camera into one affine transform
+    and maps all 20 vertices to screen pixels in a single matrix product,
+    instead of rotating, moving and scaling every corner as a Vector2.
+    Only the front tires depend on the steering angle, they are rotated in
+    car coordinates before the transform.
+    '''
+    def __init__(self, length, width, factor_overlap=1.5):
+        self.length = length
+        self.width = width
+        # factor_overlap determines how much the car goes over the tires from the front and back
+        self.body = _rectangle(2 * length / factor_overlap, width)
+        self.tire = _rectangle(length / 4, width / 4)
+        self.front_tire_centers = np.array(((length / 2, width / 2), (length / 2, -width / 2)))
+        rear_tire_centers = np.array(((-length / 2, width / 2), (-length / 2, -width / 2)))
+        self.rear_tires = (self.tire[None] + rear_tire_centers[:, None]).reshape(-1, 2)
+
+    def matches(self, length, width):
+        return self.length == length and self.width == width
+
+    def transform(self, position, heading, steering, camera, ppu):
+        '''
+        Screen polygons for a car at `position` with `heading` and tire angle
+        `steering` (both in degrees) seen from `camera`. Returns the body as a
+        (4, 2) array and the tires as a (4, 4, 2) array, front tires first.
+        '''
+        front_tires = (self.tire @ _rotation(steering).T)[None] + self.front_tire_centers[:, None]
+        vertices = np.concatenate((self.body, front_tires.reshape(-1, 2), self.rear_tires))
+        matrix = _rotation(heading) * ppu
+        offset = (np.asarray(position, np.float64) - camera) * ppu
+        screen = vertices @ matrix.T + offset
+        return screen[:4], screen[4:].reshape(4, 4, 2)
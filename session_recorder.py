@@ -0,0 +1,173 @@
+'''
+Recording of a drive for offline replay.
+
+A session consists of two append-only files:
+    <name>.slrec      the raw payloads, written back to back
+    <name>.slrec.idx  one fixed size INDEX_ENTRY per payload
+
+Image payloads are the messages exactly as received from the worker
+(frame header + JPEG), controlls and state are JSON. Records are collected
+in memory and appended a chunk at a time. Both files can be memory mapped,
+so a replay can seek to any point in time without reading the whole file.
+'''
+
+import os
+import json
+import time
+import threading
+import numpy as np
+
+RECORD_FRAME = 1
+RECORD_CONTROLLS = 2
+RECORD_STATE = 3
+
+INDEX_ENTRY = np.dtype([
+    ('time', '<f8'),    # time.time() when the record was written
+    ('offset', '<u8'),  # offset of the payload in the data file
+    ('length', '<u4'),
+    ('type', '<u4'),
+])
+
+
+class SessionRecorder:
+    def __init__(self, path, chunk_bytes=4 * 1024 * 1024):
+        self.path = path
+        self.chunk_bytes = chunk_bytes
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self._data = open(path, 'ab')
+        self._index = open(path + '.idx', 'ab')
+        self._offset = self._data.tell()
+        self._chunk = []
+        self._chunk_index = []
+        self._chunk_size = 0
+        self._closed = False
+        self._lock = threading.Lock()
+
+    def record_frame(self, message, t=None):
+        self._append(RECORD_FRAME, bytes(message), t)
+
+    def record_controlls(self, controlls, t=None):
+        self._append(RECORD_CONTROLLS, json.dumps(controlls).encode('utf-8'), t)
+
+    def record_state(self, state, t=None):
+        self._append(RECORD_STATE, json.dumps(state).encode('utf-8'), t)
+
+    def flush(self):
+        with self._lock:
+            self._flush_chunk()
+
+    def close(self):
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._flush_chunk()
+            self._data.close()
+            self._index.close()
+
+    def _append(self, record_type, payload, t):
+        if t is None:
+            t = time.time()
+        with self._lock:
+            if self._closed:
+                return # streams can still deliver messages while shutting down
+            self._chunk.append(payload)
+            self._chunk_index.append((t, self._offset, len(payload), record_type))
+            self._offset += len(payload)
+            self._chunk_size += len(payload)
+            if self._chunk_size >= self.chunk_bytes:
+                self._flush_chunk()
+
+    def _flush_chunk(self):
+        if not self._chunk:
+            return
+        # Data first, so the index never points past the end of the data file
+        self._data.write(b''.join(self._chunk))
+        self._data.flush()
+        self._index.write(np.array(self._chunk_index, INDEX_ENTRY).tobytes())
+        self._index.flush()
+        self._chunk = []
+        self._chunk_index = []
+        self._chunk_size = 0
+
+
+class SessionReplay:
+    '''
+    Plays a recorded session back into a CameraStreamServer and/or
+    ControllStreamServer. Frames and states are passed to the server's
+    feed(), so they go through the same handling as received messages
+    (stream health, decoding, queueing, timing, telemetry and recording)
+    and the controller side of the pipeline can be benchmarked without the
+    car. The ROUTER servers see them as coming from the worker `worker`.
+    speed scales the original timing, speed=None replays as fast as
+    possible.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.index = np.memmap(path + '.idx', INDEX_ENTRY, mode='r')
+        self.data = np.memmap(path, np.uint8, mode='r')
+        self.position = 0 # index of the next record to play
+
+    def __len__(self):
+        return len(self.index)
+
+    @property
+    def start_time(self):
+        return float(self.index['time'][0])
+
+    @property
+    def duration(self):
+        return float(self.index['time'][-1] - self.index['time'][0])
+
+    def seek(self, seconds):
+        '''Move to the first record at or after `seconds` from the start of the session'''
+        self.position = int(np.searchsorted(self.index['time'], self.start_time + seconds))
+
+    def read(self, position):
+        '''Return (time, type, payload) of a record'''
+        entry = self.index[position]
+        start = int(entry['offset'])
+        payload = self.data[start:start + int(entry['length'])].tobytes()
+        return float(entry['time']), int(entry['type']), payload
+
+    def records(self, record_type=None):
+        '''Iterate over (time, type, payload) from the current position'''
+        while self.position < len(self.index):
+            record = self.read(self.position)
+            self.position += 1
+            if record_type is None or record[1] == record_type:
+                yield record
+
+    def play(self, image_server=None, controll_server=None, speed=1.0, stop_event=None, worker=b'replay'):
+        t_wall_start = time.monotonic()
+        t_record_start = None
+        for t, record_type, payload in self.records():
+            if stop_event is not None and stop_event.is_set():
+                return
+            if t_record_start is None:
+                t_record_start = t
+            if speed:
+                delay = (t - t_record_start) / speed - (time.monotonic() - t_wall_start)
+                if delay > 0:
+                    time.sleep(delay)
+
+            if record_type == RECORD_FRAME and image_server is not None:
+                image_server.feed(payload, worker)
+            elif record_type == RECORD_STATE and controll_server is not None:
+                # The stamps were taken by the recording controller's clock
+                state = json.loads(payload)
+                state.pop('stamp', None)
+                state.pop('stamp_hold', None)
+                controll_server.feed(json.dumps(state).encode('utf-8'), worker)
+            elif record_type == RECORD_CONTROLLS and controll_server is not None:
+                with controll_server.controll_lock:
+                    controll_server.controlls.update(json.loads(payload))
+
+    def start(self, image_server=None, controll_server=None, speed=1.0, worker=b'replay'):
+        '''Play back in a background thread, returns the thread's stop event'''
+        stop_event = threading.Event()
+        thread = threading.Thread(target=self.play,
+                                  args=(image_server, controll_server, speed, stop_event, worker),
+                                  daemon=True)
+        thread.start()
+        return stop_event
@@ -0,0 +1,240 @@
+import math
+import time
+import logging
+import multiprocessing as mp
+from multiprocessing import shared_memory
+import numpy as np
+
+from config import Config as cfg
+from frame_protocol import FrameHeader
+
+# Header of every slot in the ring. 'lock' is a seqlock counter: it is odd
+# while the writer is updating the slot and even when the slot is stable.
+SLOT_HEADER = np.dtype([
+    ('lock', '<u8'),
+    ('frame', '<u8'),           # running number of the frame in the ring
+    ('height', '<u4'),
+    ('width', '<u4'),
+    ('channels', '<u4'),
+    ('version', '<u4'),
+    ('sequence', '<i8'),        # -1 if the frame had no header
+    ('capture_time', '<f8'),    # nan if the frame had no header
+    ('encode_time', '<f8'),
+    ('receive_time', '<f8'),
+])
+_ALIGN = 64
+
+
+def _align(n):
+    return (n + _ALIGN - 1) // _ALIGN * _ALIGN
+
+
+class SharedFrameRing:
+    '''
+    A ring of fixed size frame slots in shared memory, written by one process
+    and read by any number of processes without copying.
+
+    The writer increments a slot's seqlock counter before and after writing
+    it. A reader remembers the counter when it takes a frame and can check
+    with is_valid() whether the slot has been overwritten since. A slot is
+    only reused after `slots` further frames, so a reader that is done with a
+    frame before that never sees torn data.
+    '''
+    def __init__(self, name=None, slots=4, max_frame_bytes=800 * 600 * 3, create=True):
+        self.slots = slots
+        self.max_frame_bytes = max_frame_bytes
+        self._headers_offset = _ALIGN # first bytes hold the number of written frames
+        self._data_offset = _align(self._headers_offset + slots * SLOT_HEADER.itemsize)
+        self._slot_size = _align(max_frame_bytes)
+        size = self._data_offset + slots * self._slot_size
+
+        if create:
+            self.shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+        else:
+            # Readers are child processes of the owner and share its resource
+            # tracker with every start method (fork, spawn and forkserver), so
+            # they must not unregister the block: that would drop the owner's
+            # registration and leak the block if the owner crashes.
+            self.shm = shared_memory.SharedMemory(name=name)
+        self.name = self.shm.name
+        self._owner = create
+
+        self._write_count = np.ndarray((1,), np.uint64, self.shm.buf, 0)
+        self._headers = np.ndarray((slots,), SLOT_HEADER, self.shm.buf, self._headers_offset)
+        if create:
+            self._write_count[0] = 0
+            self._headers[:] = 0
+        self._last_read = 0
+
+    def write(self, img: np.ndarray, header: FrameHeader=None):
+        if img.nbytes > self.max_frame_bytes:
+            raise ValueError(f'Frame of {img.nbytes} bytes does not fit into a slot of {self.max_frame_bytes} bytes')
+        frame = int(self._write_count[0])
+        index = frame % self.slots
+        slot = self._headers[index:index + 1]
+
+        slot['lock'] += 1 # odd: slot is being written
+        data = self._slot_view(index, img.shape)
+        data[...] = img
+        height, width = img.shape[:2]
+        channels = img.shape[2] if img.ndim == 3 else 1
+        slot['frame'] = frame + 1
+        slot['height'] = height
+        slot['width'] = width
+        slot['channels'] = channels
+        if header is not None and header.sequence is not None:
+            slot['version'] = header.version
+            slot['sequence'] = header.sequence
+            slot['capture_time'] = header.capture_time
+            slot['encode_time'] = header.encode_time
+        else:
+            slot['version'] = 0
+            slot['sequence'] = -1
+            slot['capture_time'] = math.nan
+            slot['encode_time'] = math.nan
+        slot['receive_time'] = header.receive_time if header is not None else time.time()
+        slot['lock'] += 1 # even: slot is stable again
+
+        # Publish the frame
+        self._write_count[0] = frame + 1
+
+    def read_latest(self):
+        '''
+        Return (image, FrameHeader, token) of the newest frame that was not
+        read yet, or None. The image is a view into shared memory; pass the
+        token to is_valid() to check it was not overwritten while in use.
+        '''
+        count = int(self._write_count[0])
+        if count == self._last_read:
+            return None
+        index = (count - 1) % self.slots
+        for _ in range(3):
+            lock = int(self._headers[index]['lock'])
+            if lock % 2 == 1:
+                continue # writer is busy with this slot, try again
+            h = self._headers[index].copy()
+            shape = (int(h['height']), int(h['width']))
+            if h['channels'] > 1:
+                shape += (int(h['channels']),)
+            img = self._slot_view(index, shape)
+            if int(self._headers[index]['lock']) != lock:
+                continue
+            self._last_read = count
+            sequence = int(h['sequence'])
+            if sequence < 0:
+                header = FrameHeader(0, None, None, None, None, None, float(h['receive_time']))
+            else:
+                header = FrameHeader(int(h['version']), sequence, float(h['capture_time']),
+                                     float(h['encode_time']), shape[1], shape[0],
+                                     float(h['receive_time']))
+            return img, header, (index, lock)
+        return None
+
+    def is_valid(self, token):
+        index, lock = token
+        return int(self._headers[index]['lock']) == lock
+
+    def close(self):
+        # Drop the numpy views before closing the shared memory
+        self._write_count = None
+        self._headers = None
+        try:
+            self.shm.close()
+        except BufferError:
+            pass # a consumer still holds a frame view, the mapping goes away on exit
+        if self._owner:
+            self.shm.unlink()
+
+    def _slot_view(self, index, shape):
+        offset = self._data_offset + index * self._slot_size
+        return np.ndarray(shape, np.uint8, self.shm.buf, offset)
+
+
+def _ingest_main(ring_name, slots, max_frame_bytes, stop_event, recording_path=None):
+    '''Entry point of the ingest process: receive and decode frames into the ring'''
+    # Imported here so the parent process does not need to create the socket
+    from camera_stream_server import CameraStreamServer
+    from session_recorder import SessionRecorder
+
+    ring = SharedFrameRing(ring_name, slots, max_frame_bytes, create=False)
+
+    class RingWriterServer(CameraStreamServer):
+        def _put_image(self, img, header, worker=None):
+            self.frame_stats.add(header)
+            try:
+                ring.write(img, header)
+            except ValueError as e:
+                self.dropped_frames += 1
+                logging.warning(f'Image Stream: {e}')
+
+    server = RingWriterServer()
+    if recording_path is not None:
+        server.recorder = SessionRecorder(recording_path)
+    server.start()
+    stop_event.wait()
+    server.close()
+    if server.recorder is not None:
+        server.recorder.close()
+    ring.close()
+
+
+class MultiprocessCameraStreamServer:
+    '''
+    Runs CameraStreamServer in a child process so receiving and decoding
+    don't compete with the UI for the GIL. Frames are passed back through a
+    SharedFrameRing. Has the same start/receive_image/close interface as
+    CameraStreamServer.
+
+    Frames are received in the child process, so they can't be recorded
+    with a SessionRecorder of the parent. Set recording_path before start()
+    and the child records them into a session of its own.
+    '''
+    def __init__(self, slots=cfg.get('shared_ring_slots')):
+        width, height = cfg.get('image_size')
+        # Slots are sized for the configured image size
+        max_frame_bytes = width * height * 3
+        self.ring = SharedFrameRing(slots=int(slots), max_frame_bytes=max_frame_bytes)
+        self._max_frame_bytes = max_frame_bytes
+        self._stop_event = mp.Event()
+        self._process = None
+        self.recording_path = None # session file the ingest process records the frames to
+
+    def start(self):
+        self._process = mp.Process(target=_ingest_main,
+                                   args=(self.ring.name, self.ring.slots, self._max_frame_bytes,
+                                         self._stop_event, self.recording_path),
+                                   daemon=True)
+        self._process.start()
+        print(f"Image Stream: Ingest process started (pid {self._process.pid})")
+
+    def receive_image(self):
+        frame = self.receive_frame()
+        if frame is not None:
+            return frame[0]
+        return None
+
+    def receive_frame(self):
+        '''
+        Return the newest (image, FrameHeader) or None. The image is copied out
+        of shared memory, because the consumer keeps it (preview, SLAM) for
+        longer than it takes the writer to reuse the slot.
+        '''
+        for _ in range(3):
+            frame = self.ring.read_latest()
+            if frame is None:
+                return None
+            img, header, token = frame
+            img = img.copy()
+            if self.ring.is_valid(token):
+                return img, header
+            # The slot was overwritten while copying, take the newer frame
+        return None
+
+    def close(self):
+        print("Stopping ingest process")
+        self._stop_event.set()
+        if self._process is not None:
+            self._process.join(timeout=2)
+            if self._process.is_alive():
+                self._process.terminate()
+        self.ring.close()
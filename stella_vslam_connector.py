@@ -1,5 +1,6 @@
 
 import cv2
+import asyncio
 import numpy as np
 import pyfakewebcam
 import time
@@ -40,6 +41,13 @@ class StellaConnector:
         else:
             return False
 
+    async def check_stella_containers_async(self):
+        container_name = 'stella_vslam-socket'
+        process = await asyncio.create_subprocess_shell(f'docker ps -q -f name={container_name}',
+                                                        stdout=asyncio.subprocess.PIPE)
+        output, _ = await process.communicate()
+        return bool(output.strip())
+
     def open_stella_viewer(self):
         url = 'http://localhost:3001'
         webbrowser.open(url)
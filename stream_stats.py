@@ -0,0 +1,214 @@
+import time
+from collections import deque
+import numpy as np
+
+
+class ThroughputCounter:
+    '''
+    Counts messages and bytes of a stream and keeps a smoothed message rate.
+    '''
+    def __init__(self, smoothing=0.1):
+        self.smoothing = smoothing
+        self.messages = 0       # number of messages received
+        self.bytes = 0          # number of bytes received
+        self.rate = 0.0         # smoothed messages per second
+        self.last_seen = None   # time.monotonic() of the last message
+
+    def add(self, nbytes=0):
+        now = time.monotonic()
+        if self.last_seen is not None:
+            interval = now - self.last_seen
+            if interval > 0:
+                self.rate = (1 - self.smoothing) * self.rate + self.smoothing / interval
+        self.last_seen = now
+        self.messages += 1
+        self.bytes += nbytes
+
+    def as_dict(self):
+        return {
+            'messages': self.messages,
+            'bytes': self.bytes,
+            'rate': self.rate,
+            'last_seen': self.last_seen,
+        }
+
+
+def worker_name(identity: bytes) -> str:
+    '''Readable name for a ZMQ socket identity'''
+    try:
+        name = identity.decode('utf-8')
+        if name.isprintable():
+            return name
+    except UnicodeDecodeError:
+        pass
+    return identity.hex()
+
+
+class LatencyStats:
+    '''
+    Rolling window of latency samples (in seconds) with percentiles.
+    '''
+    def __init__(self, window=500):
+        self.samples = deque(maxlen=window)
+
+    def add(self, latency):
+        self.samples.append(latency)
+
+    def percentiles(self, q=(50, 90, 99)):
+        if not self.samples:
+            return {p: None for p in q}
+        values = np.percentile(np.fromiter(self.samples, float, len(self.samples)), q)
+        return dict(zip(q, values))
+
+
+class FrameStats:
+    '''
+    Latency and lost frame accounting based on the frame headers of one worker.
+    '''
+    def __init__(self, window=500):
+        self.latency = {
+            'receive': LatencyStats(window), # capture -> received by the controller
+            'decode': LatencyStats(window),  # capture -> decoded and queued
+        }
+        self.encode_time = LatencyStats(window)
+        self.gaps = 0           # number of gaps in the sequence numbers
+        self.lost_frames = 0    # frames missing in these gaps
+        self._last_sequence = None
+
+    def add(self, header, decoded_time=None):
+        if header.sequence is None:
+            return # legacy frame without header
+        if decoded_time is None:
+            decoded_time = time.time()
+        self.latency['receive'].add(header.receive_time - header.capture_time)
+        self.latency['decode'].add(decoded_time - header.capture_time)
+        self.encode_time.add(header.encode_time)
+
+        if self._last_sequence is not None:
+            missing = header.sequence - self._last_sequence - 1
+            # A smaller sequence number means the worker restarted
+            if missing > 0:
+                self.gaps += 1
+                self.lost_frames += missing
+        self._last_sequence = header.sequence
+
+    def as_dict(self):
+        return {
+            'latency': {stage: stats.percentiles() for stage, stats in self.latency.items()},
+            'encode_time': self.encode_time.percentiles(),
+            'gaps': self.gaps,
+            'lost_frames': self.lost_frames,
+        }
+
+
+class StreamHealth:
+    '''
+    Inter-arrival times and decode durations of the image stream, used to
+    detect when the controller can't keep up with the worker.
+    '''
+    def __init__(self, window=100):
+        self.intervals = deque(maxlen=window)
+        self.decode_times = deque(maxlen=window)
+        self._last_arrival = None
+
+    def add_arrival(self):
+        now = time.monotonic()
+        if self._last_arrival is not None:
+            self.intervals.append(now - self._last_arrival)
+        self._last_arrival = now
+
+    def add_decode_time(self, duration):
+        self.decode_times.append(duration)
+
+    def mean_interval(self):
+        return float(np.mean(self.intervals)) if self.intervals else None
+
+    def jitter(self):
+        '''Standard deviation of the inter-arrival time in seconds'''
+        return float(np.std(self.intervals)) if len(self.intervals) > 1 else 0.0
+
+    def mean_decode_time(self):
+        return float(np.mean(self.decode_times)) if self.decode_times else 0.0
+
+
+class LatencyHistogram:
+    '''
+    Fixed size histogram of durations with `resolution` seconds wide bins up
+    to `max_value`; longer durations go into an overflow bin. Memory use does
+    not grow with the number of samples.
+    '''
+    def __init__(self, resolution=0.001, max_value=1.0):
+        self.resolution = resolution
+        self.counts = np.zeros(int(round(max_value / resolution)) + 1, np.int64)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, value):
+        index = min(int(max(value, 0.0) / self.resolution), len(self.counts) - 1)
+        self.counts[index] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def mean(self):
+        return self.total / self.count if self.count else None
+
+    def percentiles(self, q=(50, 90, 99)):
+        if not self.count:
+            return {p: None for p in q}
+        cumulative = np.cumsum(self.counts)
+        # Upper edge of the bin that contains the percentile
+        indices = np.searchsorted(cumulative, np.array(q) / 100 * self.count)
+        return {p: (i + 1) * self.resolution for p, i in zip(q, indices)}
+
+    def as_dict(self):
+        return {
+            'count': self.count,
+            'mean': self.mean(),
+            'max': self.max,
+            'percentiles': self.percentiles(),
+        }
+
+
+class ControllTiming:
+    '''
+    Round trip time, jitter and missed deadlines of the controll loop.
+
+    The controller stamps every reply with its own clock and the worker
+    echoes the stamp in its next state message, together with the time it
+    held on to it ('stamp_hold'). The round trip time is the age of the
+    echoed stamp minus that hold time, so it works without synchronised
+    clocks. Jitter is the deviation of the message interval from the
+    controll period; an interval longer than 1.5 periods is a missed deadline.
+    '''
+    def __init__(self, frequency):
+        self.period = 1 / frequency
+        self.rtt = LatencyHistogram()
+        self.jitter = LatencyHistogram()
+        self.missed_deadlines = 0
+        self.messages = 0
+        self._last_message = None
+
+    def add(self, state, now=None):
+        if now is None:
+            now = time.monotonic()
+        self.messages += 1
+        if self._last_message is not None:
+            interval = now - self._last_message
+            self.jitter.add(abs(interval - self.period))
+            if interval > 1.5 * self.period:
+                self.missed_deadlines += 1
+        self._last_message = now
+
+        stamp = state.get('stamp')
+        if stamp is not None:
+            self.rtt.add(now - stamp - state.get('stamp_hold', 0.0))
+
+    def as_dict(self):
+        return {
+            'messages': self.messages,
+            'missed_deadlines': self.missed_deadlines,
+            'rtt': self.rtt.as_dict(),
+            'jitter': self.jitter.as_dict(),
+        }
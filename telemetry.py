@@ -0,0 +1,87 @@
+import time
+import threading
+import numpy as np
+from config import Config as cfg
+
+
+class TelemetryStore:
+    '''
+    Time series of the state messages reported by the worker.
+
+    Samples are kept in a preallocated NumPy structured array used as a ring,
+    so memory is fixed at `capacity` samples and the oldest samples are
+    overwritten. Timestamps grow monotonically, which allows windowed
+    queries with a binary search instead of a scan.
+
+    A sample takes 8 bytes for the time plus 4 per field, with the default
+    fields 16 bytes, so the default 360000 samples (four hours at 25 Hz)
+    are about 5.8 MB. The ROUTER controll server keeps one store per worker.
+    '''
+    def __init__(self, fields=('throttle', 'steering'), capacity=cfg.get('telemetry_capacity')):
+        self.fields = tuple(fields)
+        self.dtype = np.dtype([('time', '<f8')] + [(field, '<f4') for field in self.fields])
+        self.capacity = int(capacity)
+        self.data = np.zeros(self.capacity, self.dtype)
+        self.count = 0  # number of valid samples
+        self._head = 0  # index the next sample is written to
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return self.count
+
+    def add(self, state, t=None):
+        '''Add a state dict, fields that are missing are stored as NaN'''
+        if t is None:
+            t = time.time()
+        with self._lock:
+            self.data['time'][self._head] = t
+            for field in self.fields:
+                value = state.get(field)
+                self.data[field][self._head] = np.nan if value is None else value
+            self._head = (self._head + 1) % self.capacity
+            self.count = min(self.count + 1, self.capacity)
+
+    def window(self, start=None, end=None):
+        '''Return a copy of the samples with start <= time < end, oldest first'''
+        with self._lock:
+            if self.count < self.capacity:
+                segments = [self.data[:self.count]]
+            else:
+                # The ring has wrapped: the oldest sample is at the head
+                segments = [self.data[self._head:], self.data[:self._head]]
+            parts = []
+            for segment in segments:
+                times = segment['time']
+                lo = 0 if start is None else np.searchsorted(times, start, 'left')
+                hi = len(segment) if end is None else np.searchsorted(times, end, 'left')
+                if hi > lo:
+                    parts.append(segment[lo:hi])
+            if not parts:
+                return np.zeros(0, self.dtype)
+            return np.concatenate(parts)
+
+    def last(self, seconds):
+        '''Samples of the last `seconds` seconds'''
+        return self.window(start=time.time() - seconds)
+
+    def downsample(self, field, points, start=None, end=None):
+        '''
+        Reduce a field to at most `points` buckets for plotting. Returns a
+        dict of arrays 'time' (bucket start), 'min', 'max' and 'mean'.
+        Plotting min and max keeps short spikes visible.
+        '''
+        samples = self.window(start, end)
+        n = len(samples)
+        if n == 0:
+            empty = np.zeros(0)
+            return {'time': empty, 'min': empty, 'max': empty, 'mean': empty}
+        points = min(points, n)
+        edges = np.linspace(0, n, points + 1).astype(np.int64)[:-1]
+        values = samples[field].astype(np.float64)
+        counts = np.diff(np.append(edges, n))
+        return {
+            'time': samples['time'][edges],
+            'min': np.minimum.reduceat(values, edges),
+            'max': np.maximum.reduceat(values, edges),
+            'mean': np.add.reduceat(values, edges) / counts,
+        }
@@ -0,0 +1,176 @@
+import numpy as np
+
+
+class TraceBuffer:
+    '''
+    Stores 2D points in a NumPy array instead of a list of Vector2.
+
+    Without a capacity the buffer grows by doubling, so appending is
+    amortized O(1). With a capacity only the newest `capacity` points are
+    kept. In both cases points() returns a contiguous (n, 2) view without
+    copying, which can be transformed in one vectorized operation.
+    '''
+    def __init__(self, capacity=None, initial_size=1024):
+        self.capacity = capacity
+        # A bounded buffer uses twice its capacity, so the old points only
+        # have to be moved to the front once every `capacity` appends
+        size = 2 * capacity if capacity is not None else initial_size
+        self._data = np.empty((size, 2), np.float64)
+        self._start = 0
+        self._end = 0
+
+    def __len__(self):
+        return self._end - self._start
+
+    def append(self, point):
+        if self._end == len(self._data):
+            self._make_room()
+        self._data[self._end] = point
+        self._end += 1
+        if self.capacity is not None and len(self) > self.capacity:
+            self._start += 1
+
+    def extend(self, points):
+        points = np.asarray(points, np.float64).reshape(-1, 2)
+        if self.capacity is not None:
+            points = points[-self.capacity:]
+        n = len(points)
+        while self._end + n > len(self._data):
+            self._make_room()
+        self._data[self._end:self._end + n] = points
+        self._end += n
+        if self.capacity is not None and len(self) > self.capacity:
+            self._start = self._end - self.capacity
+
+    def points(self) -> np.ndarray:
+        return self._data[self._start:self._end]
+
+    def clear(self):
+        self._start = 0
+        self._end = 0
+
+    def _make_room(self):
+        if self.capacity is None:
+            data = np.empty((2 * len(self._data), 2), np.float64)
+            data[:self._end] = self._data[:self._end]
+            self._data = data
+        else:
+            n = len(self)
+            self._data[:n] = self._data[self._start:self._end]
+            self._start = 0
+            self._end = n
+
+
+class TraceLOD:
+    '''
+    Simplified versions of a growing TraceBuffer for drawing at different
+    zoom levels.
+
+    Level k snaps the points to a grid with cells of base_tolerance * 2**k
+    meters and keeps a point only if it lies in a different cell than the
+    point before it, so vertices closer than about one pixel are dropped.
+    Each level is only built when it is first drawn and afterwards updated
+    incrementally with the points appended since.
+
+    The simplified points are split into chunks of `chunk_size` segments,
+    each with a bounding box that grows as points arrive. visible_runs()
+    only tests the chunk boxes against the viewport, so the cost per frame
+    depends on the number of chunks and not on the length of the trace.
+    '''
+    def __init__(self, trace: TraceBuffer, pixel_tolerance=1.0, base_tolerance=0.001, levels=12, chunk_size=256):
+        if trace.capacity is not None:
+            raise ValueError('TraceLOD needs a growing TraceBuffer')
+        self.trace = trace
+        self.pixel_tolerance = pixel_tolerance
+        self.base_tolerance = base_tolerance
+        self.levels = levels
+        self.chunk_size = chunk_size
+        self._kept = {}      # level -> TraceBuffer of kept points
+        self._processed = {} # level -> number of trace points already simplified
+        self._last_cell = {} # level -> grid cell of the last processed point
+        self._boxes = {}     # level -> array of chunk bounding boxes (min x, min y, max x, max y)
+        self._chunks = {}    # level -> number of chunks in use
+
+    def level_for(self, ppu):
+        '''Coarsest level whose grid cells are at most pixel_tolerance pixels wide'''
+        tolerance = self.pixel_tolerance / ppu
+        level = int(np.floor(np.log2(tolerance / self.base_tolerance)))
+        return min(max(level, 0), self.levels - 1)
+
+    def simplified(self, level) -> np.ndarray:
+        self._update_level(level)
+        return self._kept[level].points()
+
+    def visible_runs(self, ppu, viewport_min, viewport_max):
+        '''
+        Return the simplified trace for this zoom as a list of (n, 2) arrays,
+        one for each run of consecutive chunks that touch the viewport.
+        '''
+        level = self.level_for(ppu)
+        points = self.simplified(level)
+        if len(points) < 2:
+            return []
+        boxes = self._boxes[level][:self._chunks[level]]
+        visible = np.all((boxes[:, 2:] >= viewport_min) & (boxes[:, :2] <= viewport_max), axis=1)
+        if not visible.any():
+            return []
+        # Split into runs of visible chunks
+        changes = np.flatnonzero(np.diff(visible.astype(np.int8)))
+        bounds = np.concatenate(([0], changes + 1, [len(visible)]))
+        size = self.chunk_size
+        runs = []
+        for first, last in zip(bounds[:-1], bounds[1:]):
+            if visible[first]:
+                # chunk k holds the segments between points k*size..(k+1)*size
+                runs.append(points[first * size:last * size + 1])
+        return runs
+
+    def _update_level(self, level):
+        if level not in self._kept or self._processed[level] > len(self.trace):
+            # New level, or the trace was cleared
+            self._kept[level] = TraceBuffer()
+            self._processed[level] = 0
+            self._last_cell[level] = None
+            self._boxes[level] = np.empty((16, 4), np.float64)
+            self._chunks[level] = 0
+
+        new_points = self.trace.points()[self._processed[level]:]
+        if len(new_points) == 0:
+            return
+        cells = np.floor(new_points / (self.base_tolerance * 2 ** level)).astype(np.int64)
+        previous = np.empty_like(cells)
+        previous[1:] = cells[:-1]
+        if self._last_cell[level] is None:
+            previous[0] = cells[0] + 1 # always keep the very first point
+        else:
+            previous[0] = self._last_cell[level]
+        keep = np.any(cells != previous, axis=1)
+
+        kept = len(self._kept[level])
+        self._kept[level].extend(new_points[keep])
+        self._processed[level] += len(new_points)
+        self._last_cell[level] = cells[-1]
+        self._update_boxes(level, kept)
+
+    def _update_boxes(self, level, kept):
+        # Grow the boxes of the chunks that got new points, `kept` is the
+        # number of points before the update
+        points = self._kept[level].points()
+        size = self.chunk_size
+        chunks = (len(points) - 2) // size + 1 if len(points) > 1 else 0
+        used = self._chunks[level]
+        if chunks > len(self._boxes[level]):
+            boxes = np.empty((max(chunks, 2 * len(self._boxes[level])), 4), np.float64)
+            boxes[:used] = self._boxes[level][:used]
+            self._boxes[level] = boxes
+        boxes = self._boxes[level]
+        for k in range(max(used - 1, 0), chunks):
+            # The last point before the update starts the new segments
+            new = points[max(k * size, kept - 1):(k + 1) * size + 1]
+            low, high = new.min(axis=0), new.max(axis=0)
+            if k < used:
+                low = np.minimum(low, boxes[k, :2])
+                high = np.maximum(high, boxes[k, 2:])
+            boxes[k, :2] = low
+            boxes[k, 2:] = high
+        self._chunks[level] = chunks